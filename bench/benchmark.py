@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmark the marathon_app module against an in-process fake Marathon.
+#
+# Each operation runs in a fresh copy of the module, like one Ansible task,
+# and reports the HTTP requests and bytes it cost together with its latency.
+#
+#   python bench/benchmark.py --sizes 1,100,1000 --latency 0.002
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from ansible.module_utils import basic
+from ansible.module_utils.basic import AnsibleModule
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_marathon
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'library', 'marathon_app.py')
+
+OPERATIONS = ['create', 'noop', 'update', 'restart', 'kill', 'wait', 'bulk']
+
+
+class Module(object):
+
+    def __init__(self):
+        with open(MODULE_PATH) as f:
+            self.code = compile(f.read(), MODULE_PATH, 'exec')
+
+    def load(self, args):
+        # A fresh namespace per operation, as every task runs a new module process
+        namespace = {'__name__': 'marathon_app', '__file__': MODULE_PATH}
+        exec(self.code, namespace)
+
+        basic._ANSIBLE_ARGS = json.dumps({'ANSIBLE_MODULE_ARGS': args}).encode('utf-8')
+        module = AnsibleModule(argument_spec=namespace['ARGUMENT_SPEC'], supports_check_mode=True)
+        namespace['module'] = module
+        namespace['prepareParams'](module.params)
+        return namespace, module.params
+
+    def run(self, uri, operation, args):
+        namespace, params = self.load(dict(args, uri=uri))
+        restbase = uri.rstrip('/') + '/v2'
+        return namespace[operation](restbase, params['username'], params['password'], params)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class Benchmark(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.module = Module()
+        self.results = []
+
+    def measure(self, marathon, server, size, name, calls):
+        latencies = []
+        requests = marathon.stats['requests']
+        bytes = marathon.stats['bytes_in'] + marathon.stats['bytes_out']
+        start = time.time()
+        for operation, args in calls:
+            t = time.time()
+            self.module.run(server.url, operation, args)
+            latencies.append(time.time() - t)
+        total = time.time() - start
+
+        count = len(calls)
+        result = {
+            'size': size,
+            'operation': name,
+            'calls': count,
+            'requests_per_call': float(marathon.stats['requests'] - requests) / count,
+            'bytes_per_call': float(marathon.stats['bytes_in'] + marathon.stats['bytes_out'] - bytes) / count,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'total_s': total,
+        }
+        self.results.append(result)
+        self.report(result)
+
+    def report(self, result):
+        if self.options.json:
+            print(json.dumps(result))
+        else:
+            print('%(size)6d  %(operation)-8s %(calls)6d  %(requests_per_call)8.2f  %(bytes_per_call)10.0f  %(p50_ms)9.2f  %(p99_ms)9.2f  %(total_s)9.2f' % result)
+        sys.stdout.flush()
+
+    def app(self, i, **kwargs):
+        app = {'id': '/bench/app-%05d' % i, 'cmd': 'sleep 3600', 'instances': 1, 'env': {'INDEX': i}}
+        app.update(kwargs)
+        return app
+
+    def fleet(self, size):
+        marathon = fake_marathon.Marathon(latency=self.options.latency, deployment_duration=0)
+        server = fake_marathon.Server(marathon).start()
+        try:
+            ops = self.options.operations
+            apps = [self.app(i) for i in range(size)]
+
+            if 'create' in ops:
+                self.measure(marathon, server, size, 'create', [('present', app) for app in apps])
+            else:
+                self.module.run(server.url, 'apps_present', {'apps': apps})
+
+            if 'noop' in ops:
+                self.measure(marathon, server, size, 'noop', [('present', app) for app in apps])
+            if 'update' in ops:
+                self.measure(marathon, server, size, 'update', [('present', self.app(i, cmd='sleep 7200')) for i in range(size)])
+            if 'restart' in ops:
+                self.measure(marathon, server, size, 'restart', [('restart', {'id': app['id']}) for app in apps])
+            if 'kill' in ops:
+                self.measure(marathon, server, size, 'kill', [('kill', {'id': app['id']}) for app in apps])
+
+            # Rollout time including the wait for deployments to complete
+            marathon.deployment_duration = self.options.deployment_duration
+            if 'wait' in ops:
+                sample = apps[:self.options.wait_sample]
+                self.measure(marathon, server, size, 'wait', [('present', dict(self.app(i, instances=2), waitTimeout=600)) for i in range(len(sample))])
+            if 'bulk' in ops:
+                self.measure(marathon, server, size, 'bulk', [('apps_present', {'apps': [self.app(i, instances=3) for i in range(size)], 'waitTimeout': 600})])
+        finally:
+            server.stop()
+
+    def run(self):
+        if not self.options.json:
+            print('  size  op        calls  req/call  bytes/call    p50(ms)    p99(ms)   total(s)')
+        for size in self.options.sizes:
+            self.fleet(size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the marathon_app module against a fake Marathon.')
+    parser.add_argument('--sizes', default='1,10,100,1000,5000', help='comma separated fleet sizes')
+    parser.add_argument('--operations', default=','.join(OPERATIONS), help='comma separated operations among %s' % ', '.join(OPERATIONS))
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every Marathon response')
+    parser.add_argument('--deployment-duration', type=float, default=0.5, help='seconds a deployment takes to complete')
+    parser.add_argument('--wait-sample', type=int, default=10, help='number of apps deployed with wait_timeout per fleet')
+    parser.add_argument('--json', action='store_true', help='print one JSON document per result')
+    options = parser.parse_args()
+    options.sizes = [int(x) for x in options.sizes.split(',')]
+    options.operations = options.operations.split(',')
+
+    Benchmark(options).run()
+
+
+if __name__ == '__main__':
+    main()
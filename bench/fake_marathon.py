@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# In-process stand-in for the Marathon v2 REST API, used to benchmark the
+# marathon_app module without a Mesos cluster.
+
+import copy
+import gzip
+import io
+import json
+import re
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+
+def now():
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()) + '.%03dZ' % (int(time.time() * 1000) % 1000)
+
+
+class Marathon(object):
+
+    def __init__(self, latency=0.0, deployment_duration=0.0, hosts=None, fail_deployments=None, kill_delay=0.0):
+        self.latency = latency
+        self.deployment_duration = deployment_duration
+        # Like Mesos reporting TASK_KILLED, killed tasks are still counted for a while
+        self.kill_delay = kill_delay
+        self.hosts = hosts or ['agent-%d' % i for i in range(1, 11)]
+        self.fail_deployments = fail_deployments or set()
+        self.lock = threading.RLock()
+        self.apps = {}
+        self.versions = {}
+        self.deployments = {}
+        self.delays = {}
+        self.dependencies = {}
+        self.task_ids = {}
+        self.task_counter = 0
+        self.subscribers = []
+        self.stats = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0, 'by_endpoint': {}}
+        self.leader = None
+
+    # Apps
+
+    def add_app(self, definition, instances_running=None):
+        with self.lock:
+            app = self._store_app(definition)
+            running = app['instances'] if instances_running is None else instances_running
+            app['tasksRunning'] = app['tasksHealthy'] = running
+            return app
+
+    def _store_app(self, definition):
+        definition = copy.deepcopy(definition)
+        id = '/' + definition['id'].strip('/')
+        version = now()
+        app = copy.deepcopy(self.apps.get(id, {}))
+        if 'version' in definition and id in self.versions and definition['version'] in self.versions[id]:
+            app.update(copy.deepcopy(self.versions[id][definition['version']]))
+        else:
+            app.update(definition)
+        app['id'] = id
+        app.setdefault('instances', 1)
+        app.setdefault('cpus', 1.0)
+        app.setdefault('mem', 128.0)
+        app.setdefault('disk', 0)
+        app.setdefault('executor', '')
+        app.setdefault('env', {})
+        app.setdefault('labels', {})
+        app.setdefault('constraints', [])
+        app.setdefault('upgradeStrategy', {'minimumHealthCapacity': 1, 'maximumOverCapacity': 1})
+        if not app.get('ports'):
+            app['ports'] = [10000 + len(self.apps)]
+        app.setdefault('tasksRunning', 0)
+        app.setdefault('tasksHealthy', 0)
+        app.setdefault('tasksStaged', 0)
+        app.setdefault('tasksUnhealthy', 0)
+        app['version'] = version
+        app['deployments'] = []
+        self.apps[id] = app
+        stored = dict((k, v) for k, v in app.items() if not k.startswith('tasks') and k != 'deployments')
+        self.versions.setdefault(id, {})[version] = copy.deepcopy(stored)
+        return app
+
+    def _deploy(self, ids, kind='deploy'):
+        deployment = {
+            'id': str(uuid.uuid4()),
+            'version': now(),
+            'affectedApps': sorted(ids),
+            'kind': kind,
+            'started': time.time(),
+        }
+        self.deployments[deployment['id']] = deployment
+        for id in ids:
+            if id in self.apps:
+                self.apps[id]['deployments'].append({'id': deployment['id']})
+                self.apps[id]['tasksStaged'] = self.apps[id]['instances']
+                self.apps[id]['tasksHealthy'] = 0
+        return deployment
+
+    def tick(self):
+        with self.lock:
+            for deployment in list(self.deployments.values()):
+                if time.time() - deployment['started'] < self.deployment_duration:
+                    continue
+                del self.deployments[deployment['id']]
+                failed = deployment['id'] in self.fail_deployments or bool(set(deployment['affectedApps']) & self.fail_deployments)
+                for id in deployment['affectedApps']:
+                    app = self.apps.get(id)
+                    if app is None:
+                        continue
+                    app['deployments'] = [d for d in app['deployments'] if d['id'] != deployment['id']]
+                    if deployment['kind'] == 'delete':
+                        del self.apps[id]
+                        continue
+                    app['tasksStaged'] = 0
+                    if not failed:
+                        app['tasksRunning'] = app['tasksHealthy'] = app['instances']
+                    elif deployment['kind'] != 'scale':
+                        # The tasks of the new version never came up
+                        app['tasksRunning'] = app['tasksHealthy'] = 0
+                event = 'deployment_failed' if failed else 'deployment_success'
+                self.publish({'eventType': event, 'id': deployment['id'], 'timestamp': now()})
+
+    def publish(self, event):
+        for queue in list(self.subscribers):
+            queue.append(event)
+
+    # Groups
+
+    def group(self, id):
+        id = '/' + id.strip('/')
+        prefix = '' if id == '/' else id
+        apps = [a for a in self.apps.values() if a['id'].startswith(prefix + '/')]
+        direct = [a for a in apps if a['id'].rsplit('/', 1)[0] == prefix]
+        children = sorted(set(prefix + '/' + a['id'][len(prefix) + 1:].split('/')[0] for a in apps if a not in direct))
+        return {
+            'id': id,
+            'apps': [self.public(a) for a in direct],
+            'groups': [self.group(c) for c in children],
+            'dependencies': self.dependencies.get(id, []),
+        }
+
+    def store_dependencies(self, group, prefix=''):
+        gid = '/' + (group.get('id') or '').strip('/')
+        if not group.get('id', '').startswith('/') and prefix:
+            gid = prefix.rstrip('/') + gid
+        parent = gid.rsplit('/', 1)[0]
+        self.dependencies[gid] = [d if d.startswith('/') else parent + '/' + d for d in group.get('dependencies') or []]
+        for child in group.get('groups', []):
+            self.store_dependencies(child, gid)
+
+    def group_apps(self, group, prefix=''):
+        gid = '/' + (group.get('id') or '').strip('/')
+        if not group.get('id', '').startswith('/') and prefix:
+            gid = prefix.rstrip('/') + gid
+        apps = []
+        for app in group.get('apps', []):
+            app = dict(app)
+            if not app['id'].startswith('/'):
+                app['id'] = gid.rstrip('/') + '/' + app['id']
+            apps.append(app)
+        for child in group.get('groups', []):
+            apps.extend(self.group_apps(child, gid))
+        return apps
+
+    # Tasks
+
+    def tasks(self, app):
+        # Tasks keep their id until they are killed, replacements get new ones
+        ids = self.task_ids.setdefault(app['id'], [])
+        del ids[app['tasksRunning']:]
+        while len(ids) < app['tasksRunning']:
+            self.task_counter += 1
+            ids.append('%s.task-%d' % (app['id'].strip('/').replace('/', '_'), self.task_counter))
+        ret = []
+        for i, id in enumerate(ids):
+            ret.append({
+                'id': id,
+                'appId': app['id'],
+                'host': self.hosts[(hash(app['id']) + i) % len(self.hosts)],
+                'ports': [31000 + i],
+                'startedAt': app['version'],
+                'version': app['version'],
+            })
+        return ret
+
+    def kill(self, app, tasks, restore):
+        def killed():
+            with self.lock:
+                ids = set(t['id'] for t in tasks)
+                self.task_ids[app['id']] = [x for x in self.task_ids.get(app['id'], []) if x not in ids]
+                app['tasksRunning'] = max(0, app['tasksRunning'] - len(tasks))
+                app['tasksHealthy'] = max(0, app['tasksHealthy'] - len(tasks))
+                app['tasksStaged'] += len(tasks)
+            threading.Timer(self.deployment_duration, restore, [app]).start()
+
+        if self.kill_delay:
+            threading.Timer(self.kill_delay, killed).start()
+        else:
+            killed()
+
+    def public(self, app):
+        return copy.deepcopy(app)
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def marathon(self):
+        return self.server.marathon
+
+    def reply(self, status, body=None, headers=None):
+        payload = b''
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+        headers = dict(headers or {})
+        if payload and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            out = io.BytesIO()
+            f = gzip.GzipFile(fileobj=out, mode='wb')
+            f.write(payload)
+            f.close()
+            payload = out.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+        with self.marathon.lock:
+            self.marathon.stats['bytes_out'] += len(payload)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('X-Marathon-Leader', 'http://%s' % (self.marathon.leader or '%s:%d' % self.server.server_address))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+        with self.marathon.lock:
+            self.marathon.stats['bytes_in'] += len(data)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+        return json.loads(data.decode('utf-8')) if data else None
+
+    def authorized(self):
+        token = self.server.token
+        if token is None:
+            return True
+        if self.path.startswith('/acs/api/v1/auth/login'):
+            return True
+        return self.headers.get('Authorization') == 'token=%s' % token
+
+    def handle_any(self, method):
+        marathon = self.marathon
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        path = re.sub('/+', '/', url.path).rstrip('/') or '/'
+        endpoint = method + ' ' + re.sub(r'/v2/(apps|groups|deployments|queue|tasks)/.+?(/(restart|tasks|versions|delay))?$', r'/v2/\1/{id}\2', path)
+        with marathon.lock:
+            marathon.stats['requests'] += 1
+            marathon.stats['by_endpoint'][endpoint] = marathon.stats['by_endpoint'].get(endpoint, 0) + 1
+        if marathon.latency:
+            time.sleep(marathon.latency)
+        if not self.authorized():
+            return self.reply(401, {'message': 'Unauthorized'})
+        marathon.tick()
+
+        if path == '/acs/api/v1/auth/login' and method == 'POST':
+            self.read_body()
+            return self.reply(200, {'token': self.server.token})
+        if path == '/v2/leader':
+            return self.reply(200, {'leader': marathon.leader or '%s:%d' % self.server.server_address})
+        if path == '/v2/events':
+            return self.events(query)
+
+        with marathon.lock:
+            return self.route(method, path, query)
+
+    def route(self, method, path, query):
+        marathon = self.marathon
+        force = query.get('force', ['false'])[0] == 'true'
+
+        if path == '/v2/apps':
+            if method == 'GET':
+                apps = marathon.apps.values()
+                if 'id' in query:
+                    apps = [a for a in apps if query['id'][0] in a['id']]
+                if 'label' in query:
+                    key = query['label'][0].split('==')[0]
+                    apps = [a for a in apps if key in a.get('labels', {})]
+                return self.reply(200, {'apps': [marathon.public(a) for a in sorted(apps, key=lambda a: a['id'])]})
+            body = self.read_body()
+            if method == 'POST':
+                id = '/' + body['id'].strip('/')
+                if id in marathon.apps:
+                    return self.reply(409, {'message': 'An app with id [%s] already exists.' % id})
+                app = marathon._store_app(body)
+                deployment = marathon._deploy([app['id']])
+                ret = marathon.public(app)
+                ret['deployments'] = [{'id': deployment['id']}]
+                return self.reply(201, ret)
+            if method in ('PUT', 'PATCH'):
+                ids = ['/' + a['id'].strip('/') for a in body]
+                locked = self.locked(ids, force)
+                if locked:
+                    return self.reply(409, {'message': 'App is locked by one or more deployments.', 'deployments': [{'id': d} for d in locked]})
+                for a in body:
+                    marathon._store_app(a)
+                deployment = marathon._deploy(ids)
+                return self.reply(200, {'deploymentId': deployment['id'], 'version': deployment['version']})
+
+        match = re.match(r'^/v2/apps(/.+?)(/restart|/tasks|/versions(/.+)?)?$', path)
+        if match:
+            id, sub, version = match.group(1), match.group(2), match.group(3)
+            app = marathon.apps.get(id)
+            if sub == '/restart' and method == 'POST':
+                if app is None:
+                    return self.reply(404, {'message': 'App %s does not exist' % id})
+                self.read_body()
+                deployment = marathon._deploy([id], 'restart')
+                return self.reply(200, {'deploymentId': deployment['id'], 'version': deployment['version'], 'deployments': [{'id': deployment['id']}]})
+            if sub == '/tasks':
+                if app is None:
+                    return self.reply(404, {'message': 'App %s does not exist' % id})
+                tasks = marathon.tasks(app)
+                if method == 'GET':
+                    return self.reply(200, {'tasks': tasks})
+                if 'host' in query:
+                    tasks = [t for t in tasks if t['host'] == query['host'][0]]
+                if query.get('scale', ['false'])[0] == 'true':
+                    app['instances'] -= len(tasks)
+                    app['tasksRunning'] = app['tasksHealthy'] = app['instances']
+                    deployment = marathon._deploy([id], 'scale')
+                    return self.reply(200, {'deploymentId': deployment['id'], 'version': deployment['version']})
+                marathon.kill(app, tasks, self.restore)
+                return self.reply(200, {'tasks': tasks})
+            if sub and sub.startswith('/versions'):
+                if id not in marathon.versions:
+                    return self.reply(404, {'message': 'App %s does not exist' % id})
+                if version:
+                    return self.reply(200, marathon.versions[id][version.strip('/')])
+                return self.reply(200, {'versions': sorted(marathon.versions[id], reverse=True)})
+            if method == 'GET':
+                if app is None:
+                    return self.reply(404, {'message': 'App %s does not exist' % id})
+                return self.reply(200, {'app': marathon.public(app)})
+            if method in ('PUT', 'PATCH'):
+                body = self.read_body()
+                locked = self.locked([id], force)
+                if locked:
+                    return self.reply(409, {'message': 'App is locked by one or more deployments.', 'deployments': [{'id': d} for d in locked]})
+                body['id'] = id
+                if method == 'PATCH' or query.get('partialUpdate', ['false'])[0] == 'true' or app is None:
+                    merged = copy.deepcopy(app or {})
+                    merged.pop('version', None)
+                    merged.update(body)
+                    body = merged
+                marathon._store_app(body)
+                deployment = marathon._deploy([id])
+                return self.reply(200, {'deploymentId': deployment['id'], 'version': deployment['version']})
+            if method == 'DELETE':
+                if app is None:
+                    return self.reply(404, {'message': 'App %s does not exist' % id})
+                deployment = marathon._deploy([id], 'delete')
+                return self.reply(200, {'deploymentId': deployment['id'], 'version': deployment['version']})
+
+        if path == '/v2/deployments':
+            return self.reply(200, [dict((k, v) for k, v in d.items() if k not in ('started', 'kind')) for d in marathon.deployments.values()])
+        match = re.match(r'^/v2/deployments/(.+)$', path)
+        if match and method == 'DELETE':
+            deployment = marathon.deployments.pop(match.group(1), None)
+            if deployment is None:
+                return self.reply(404, {'message': 'DeploymentPlan %s does not exist' % match.group(1)})
+            for id in deployment['affectedApps']:
+                if id in marathon.apps:
+                    marathon.apps[id]['deployments'] = [d for d in marathon.apps[id]['deployments'] if d['id'] != deployment['id']]
+            if force:
+                return self.reply(202)
+            rollback = marathon._deploy(deployment['affectedApps'], 'rollback')
+            return self.reply(200, {'deploymentId': rollback['id'], 'version': rollback['version']})
+
+        match = re.match(r'^/v2/groups(/.*)?$', path)
+        if match:
+            id = match.group(1) or '/'
+            if method == 'GET':
+                group = marathon.group(id)
+                if id != '/' and not group['apps'] and not group['groups']:
+                    return self.reply(404, {'message': 'Group %s does not exist' % id})
+                return self.reply(200, group)
+            if method == 'PUT':
+                body = self.read_body()
+                body.setdefault('id', id)
+                apps = marathon.group_apps(body)
+                ids = [a['id'] for a in apps]
+                locked = self.locked(ids, force)
+                if locked:
+                    return self.reply(409, {'message': 'Group is locked by one or more deployments.', 'deployments': [{'id': d} for d in locked]})
+                for a in apps:
+                    marathon._store_app(a)
+                marathon.store_dependencies(body)
+                deployment = marathon._deploy(ids)
+                return self.reply(200, {'deploymentId': deployment['id'], 'version': deployment['version']})
+            if method == 'DELETE':
+                ids = [a for a in marathon.apps if a.startswith(id.rstrip('/') + '/')]
+                if not ids:
+                    return self.reply(404, {'message': 'Group %s does not exist' % id})
+                deployment = marathon._deploy(ids, 'delete')
+                return self.reply(200, {'deploymentId': deployment['id'], 'version': deployment['version']})
+
+        if path == '/v2/queue':
+            queue = []
+            for id, delay in marathon.delays.items():
+                app = marathon.apps.get(id)
+                if app is None:
+                    continue
+                queue.append({
+                    'app': marathon.public(app),
+                    'count': app['instances'] - app['tasksRunning'],
+                    'delay': {'timeLeftSeconds': delay, 'overdue': False},
+                    'processedOffersSummary': {'rejectSummaryLastOffers': [{'reason': 'InsufficientMemory', 'declined': 3, 'processed': 3}]},
+                })
+            return self.reply(200, {'queue': queue})
+        match = re.match(r'^/v2/queue(/.+)/delay$', path)
+        if match and method == 'DELETE':
+            if marathon.delays.pop(match.group(1), None) is None:
+                return self.reply(404, {'message': 'Application %s not found in tasks queue.' % match.group(1)})
+            return self.reply(204)
+
+        if path == '/v2/tasks' and method == 'GET':
+            tasks = []
+            for app in marathon.apps.values():
+                tasks.extend(marathon.tasks(app))
+            return self.reply(200, {'tasks': tasks})
+        if path == '/v2/tasks/delete' and method == 'POST':
+            body = self.read_body()
+            ids = set(body.get('ids', []))
+            killed = []
+            apps = set()
+            for app in marathon.apps.values():
+                for task in marathon.tasks(app):
+                    if task['id'] in ids:
+                        killed.append(task)
+                        apps.add(app['id'])
+            if query.get('scale', ['false'])[0] == 'true':
+                for task in killed:
+                    marathon.apps[task['appId']]['instances'] -= 1
+                deployment = marathon._deploy(sorted(apps), 'scale')
+                return self.reply(200, {'deploymentId': deployment['id'], 'version': deployment['version']})
+            for id in apps:
+                marathon.kill(marathon.apps[id], [t for t in killed if t['appId'] == id], self.restore)
+            return self.reply(200, {'tasks': killed})
+
+        return self.reply(404, {'message': 'Not found: %s %s' % (method, path)})
+
+    def restore(self, app):
+        with self.marathon.lock:
+            app['tasksHealthy'] = app['tasksRunning'] = app['instances']
+            app['tasksStaged'] = 0
+
+    def locked(self, ids, force):
+        if force:
+            for deployment in list(self.marathon.deployments.values()):
+                if set(deployment['affectedApps']) & set(ids):
+                    del self.marathon.deployments[deployment['id']]
+                    for id in deployment['affectedApps']:
+                        if id in self.marathon.apps:
+                            self.marathon.apps[id]['deployments'] = []
+            return []
+        return sorted(set(d['id'] for d in self.marathon.deployments.values() if set(d['affectedApps']) & set(ids)))
+
+    def events(self, query):
+        types = query.get('event_type')
+        queue = []
+        self.marathon.subscribers.append(queue)
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b'event: event_stream_attached\ndata: {"eventType":"event_stream_attached"}\n\n')
+            self.wfile.flush()
+            deadline = time.time() + 600
+            while time.time() < deadline:
+                self.marathon.tick()
+                while queue:
+                    event = queue.pop(0)
+                    if types and event['eventType'] not in types:
+                        continue
+                    self.wfile.write(('event: %s\ndata: %s\n\n' % (event['eventType'], json.dumps(event))).encode('utf-8'))
+                    self.wfile.flush()
+                time.sleep(0.01)
+        except (IOError, OSError):
+            pass
+        finally:
+            self.marathon.subscribers.remove(queue)
+            self.close_connection = True
+
+    def do_GET(self):
+        self.handle_any('GET')
+
+    def do_POST(self):
+        self.handle_any('POST')
+
+    def do_PUT(self):
+        self.handle_any('PUT')
+
+    def do_PATCH(self):
+        self.handle_any('PATCH')
+
+    def do_DELETE(self):
+        self.handle_any('DELETE')
+
+
+class Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, marathon, token=None, address=('127.0.0.1', 0)):
+        HTTPServer.__init__(self, address, Handler)
+        self.marathon = marathon
+        self.token = token
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -12,19 +12,48 @@ version_added: "2.2"
 short_description: start and stop applications with Marathon
 description:
   - Start and stop applications with Marathon.
+  - In check mode, the current state of the apps is read from Marathon and the operations that would be performed are returned in I(plan), without changing anything.
 author: "Ludovic Claude (@ludovicc)"
 
 options:
   uri:
     required: true
     description:
-      - Base URI for the Marathon instance
+      - Base URI for the Marathon instance, or a list of base URIs of the Marathon instances of a cluster.
+      - When the Marathon instance used cannot be reached, requests fail over to the next one of the list.
+      - Requests are sent on persistent connections of the module itself, so proxy environment variables like C(https_proxy) are not used.
+
+  leader_discovery:
+    required: false
+    default: false
+    description:
+      - If C(yes), ask Marathon for its leader with C(GET /v2/leader) and send all the requests straight to it instead of letting another instance proxy them.
+      - The leader is followed when Marathon reports that it changed, and discovered again through the other instances when it cannot be reached.
+      - Ignored for URIs with a path, where the leader address is usually not reachable.
+
+  leader_cache_file:
+    required: false
+    default: null
+    description:
+      - Path of a file, on the host running the module, where the discovered leader is shared between module runs.
+
+  leader_cache_ttl:
+    required: false
+    default: 60
+    description:
+      - Seconds for which a leader stored in I(leader_cache_file) is reused.
 
   state:
-    choices: [ present, absent, restart, kill ]
+    choices: [ present, absent, restart, kill, scaled, wait, queue, reconcile ]
     default: "present"
     description:
       - The operation to perform.
+      - With C(present), an existing app is only updated when its definition differs from the one deployed in Marathon.
+      - C(kill) kills the tasks of the app with I(id), or the tasks selected with I(host) and I(task_ids) across all apps in a single request.
+      - C(scaled) only changes the number of I(instances) of an existing app, sending nothing else to Marathon.
+      - C(queue) reports the instances of the app, or of all the apps under the I(id) prefix, that Marathon is still waiting to launch, with their launch delay and the reasons offers were declined.
+      - C(reconcile) makes the apps under I(prefix) match I(apps) exactly, creating and updating apps with a single request and removing the apps missing from I(apps). Run it in check mode to only get the plan.
+      - C(wait) waits for the deployments listed in I(deployment_ids) to complete, for example the ones started by earlier tasks run without I(wait_timeout).
 
   username:
     required: false
@@ -38,10 +67,48 @@ options:
     description:
       - The password to log-in with.
 
+  principal:
+    required: false
+    default: null
+    description:
+      - Service account to log in with to a DC/OS style login endpoint, instead of I(username) and I(password). The token obtained is sent as C(Authorization: token=...).
+      - Requires I(principal_password) or I(private_key).
+
+  principal_password:
+    required: false
+    default: null
+    description:
+      - Password of I(principal).
+
+  private_key:
+    required: false
+    default: null
+    description:
+      - Path of the RSA private key of I(principal), used to sign the login request. Requires the PyJWT library.
+
+  login_url:
+    required: false
+    default: null
+    description:
+      - URL of the login endpoint. Defaults to C(/acs/api/v1/auth/login) on the host of the I(uri) in use, failing over to the hosts of the others.
+
+  token_cache_file:
+    required: false
+    default: null
+    description:
+      - Path of a file, on the host running the module, where tokens are cached by login endpoint and principal, so that the module runs of all hosts and tasks share one login.
+      - The file is only readable by its owner.
+
+  token_refresh:
+    required: false
+    default: 300
+    description:
+      - Seconds before the expiry of the token at which a new one is requested. Tokens rejected by Marathon are renewed as well.
+
   id:
-    required: true
+    required: false
     description:
-      - Unique identifier for the app consisting of a series of names separated by slashes.
+      - Unique identifier for the app consisting of a series of names separated by slashes. Required unless I(apps) or I(group) is used, or C(kill) selects tasks with I(host) or I(task_ids).
 
   cmd:
     aliases: [ command ]
@@ -105,9 +172,10 @@ options:
 
   instances:
     required: false
-    default: 1
+    default: null
     description:
-      - The number of instances of this application to start.
+      - The number of instances of this application to start. Marathon starts 1 instance of new apps when it is not set, and keeps the instances of existing apps.
+      - Required with C(scaled), for each app of I(apps) too. C(0) suspends the app.
 
   executor:
     required: false
@@ -300,6 +368,51 @@ options:
     description:
       - If the app is affected by a running deployment, then the update operation will fail. The current deployment can be overridden by setting the I(force) query parameter.
 
+  host:
+    required: false
+    default: null
+    description:
+      - With C(kill), only kill the tasks running on this agent, for example to drain it for maintenance. Without I(id), the tasks of every app on the agent are killed.
+
+  task_ids:
+    required: false
+    default: null
+    description:
+      - With C(kill), the ids of the tasks to kill, whatever app they belong to.
+
+  scale:
+    required: false
+    default: false
+    description:
+      - With C(kill), scale the apps down by the number of killed tasks instead of replacing them.
+      - Without I(scale) and with I(wait_timeout), wait for the replacement tasks to be healthy before returning.
+
+  partial_update:
+    required: false
+    default: false
+    description:
+      - If C(yes), C(present) only sends the fields that differ from the deployed app with C(PATCH /v2/apps/{id}), leaving fields changed out of band untouched. The whole definition is still sent when a field has to be removed.
+      - Falls back to C(PUT /v2/apps/{id}?partialUpdate=true) for Marathon versions without C(PATCH).
+
+  stuck_deployment:
+    required: false
+    default: "recreate"
+    choices: [ recreate, rollback, cancel ]
+    description:
+      - What C(present) does when the app is still being deployed by another deployment.
+      - C(recreate) destroys the app and creates it again, stopping all its tasks.
+      - C(rollback) cancels the blocking deployment with C(DELETE /v2/deployments/{id}), waits for Marathon to roll it back, then updates the app. Healthy tasks keep running.
+      - C(cancel) cancels the blocking deployment with C(force=true), without rolling it back, then updates the app.
+
+  on_failure:
+    required: false
+    default: "fail"
+    choices: [ fail, rollback ]
+    description:
+      - What C(present) does when the update of an existing app fails or times out while waiting for it, which requires I(wait_timeout).
+      - C(rollback) cancels the failing deployment, deploys again the version running before the update, and waits for it. The task still fails, and reports the version restored and both deployments in I(rollback).
+      - Polling cannot tell failed deployments from completed ones, so unless I(wait_mode=events), the app must also run the new version with the I(wait_healthy_fraction) of its instances healthy within I(wait_timeout).
+
   wait_timeout:
     aliases: [ waitTimeout ]
     required: false
@@ -307,11 +420,209 @@ options:
     description:
       - If set, wait for the application to become available until timeout seconds.
 
+  wait_mode:
+    required: false
+    default: "poll"
+    choices: [ poll, events ]
+    description:
+      - How to wait for deployments when I(wait_timeout) is set.
+      - C(poll) queries the list of deployments every second.
+      - C(events) listens to deployment events on the Marathon event stream, which returns as soon as the deployment succeeds and fails immediately when it fails. Falls back to polling if the event stream is not available.
+
+  trace_file:
+    required: false
+    default: null
+    description:
+      - Path of a file, on the host running the module, where every request made to Marathon is appended as a JSON line with its method, path, status, bytes sent and received, and duration.
+
+  profile_file:
+    required: false
+    default: null
+    description:
+      - Path of a file, on the host running the module, where the cProfile statistics of the operation are written. They can be read with the pstats module.
+
+  return_fields:
+    required: false
+    default: null
+    description:
+      - Fields of the Marathon response to return in I(meta), as dotted paths such as C(app.version) or C(deploymentId). Lists are projected item by item.
+      - By default the whole response is returned, which can weigh megabytes on large clusters.
+      - Responses the module only needs a few fields from, like deployments and tasks, are parsed incrementally when the ijson library, version 3.1 or later, is installed.
+
+  apps:
+    required: false
+    default: null
+    description:
+      - A list of app definitions to manage in a single call, each one accepting the same options as a single app (I(id), I(cmd), I(docker_image)...).
+      - With C(present), all the apps whose definition changed are deployed with a single request and waited for together.
+      - Supported with the C(present), C(absent), C(scaled) and C(reconcile) operations. Either I(id) or I(apps) is required.
+      - With C(reconcile), ids may be relative to I(prefix), and an empty list removes every app under I(prefix).
+
+  prefix:
+    required: false
+    default: null
+    description:
+      - With C(reconcile), the group under which the apps deployed in Marathon must be exactly the ones in I(apps).
+
+  max_deletions:
+    required: false
+    default: 5
+    description:
+      - With C(reconcile), the task fails before changing anything when more apps than this would be removed, which protects against an incomplete I(apps) list.
+
+  max_parallel:
+    required: false
+    default: 0
+    description:
+      - When set with I(apps), apps are deployed or removed one by one by up to I(max_parallel) concurrent workers instead of a single bulk request.
+      - Apps are ordered by their I(dependencies) within the list, an app is started as soon as the apps it depends on are done and removed before them with C(absent). Set I(wait_timeout) so that an app is only done once its deployment completed.
+      - Dependency cycles fail the task before anything is deployed, and no new app is started after a failure.
+
+  app_cache:
+    required: false
+    default: false
+    description:
+      - If C(yes), read all the apps once with C(GET /v2/apps) and look apps up in this snapshot instead of fetching them one by one. Useful when many apps are managed in the same run.
+      - Apps changed by the module are fetched again from Marathon.
+
+  app_cache_id:
+    required: false
+    default: null
+    description:
+      - Only put in the snapshot the apps whose id contains this string, for example a group prefix such as C(/team/).
+
+  app_cache_label:
+    required: false
+    default: null
+    description:
+      - Only put in the snapshot the apps matching this label selector, for example C(team==billing). Apps missing from the snapshot are then fetched from Marathon.
+
+  fingerprint_label:
+    required: false
+    default: null
+    description:
+      - Name of a label where the SHA-256 of the desired app definition is stored on deploy, for example C(ANSIBLE_FINGERPRINT).
+      - An app whose label holds the same fingerprint is only compared on its I(instances), which are left out of the fingerprint since scaling an app does not update its labels. With I(apps), only the fingerprints of the apps are listed first, and only the apps whose fingerprint differs are fetched and compared.
+      - A difference in the fingerprint alone does not update an app, so apps deployed before the option was set get their label with their next change.
+
+  app_cache_file:
+    required: false
+    default: null
+    description:
+      - Path of a file on the host running the module where the snapshot is shared between module runs, keyed by Marathon URI and filters. Usually combined with C(delegate_to) the control node.
+
+  app_cache_ttl:
+    required: false
+    default: 60
+    description:
+      - Seconds for which a snapshot stored in I(app_cache_file) is reused.
+
+  group:
+    required: false
+    default: null
+    description:
+      - A group definition with the properties I(id), I(apps), I(groups) and I(dependencies), deployed as a whole with a single request to C(/v2/groups). Marathon then plans the rolling upgrade of all the apps of the group at once.
+      - Apps accept the same options as a single app, their I(id) can be relative to the group. The group I(id) defaults to I(id).
+      - Apps and groups missing from the definition are removed from the group by Marathon.
+      - Supported with the C(present) and C(absent) operations.
+
+  reset_delay:
+    required: false
+    default: false
+    description:
+      - With C(queue), reset the launch delay of the queued apps, so that Marathon launches them at once instead of backing off for up to I(maxLaunchDelaySeconds).
+      - With C(present), reset the launch delay of the app after it is updated, so that a fixed release of a crash looping app rolls out immediately.
+
+  deployment_ids:
+    required: false
+    default: null
+    description:
+      - The deployments to wait for with C(wait). All of them are tracked together with a single query of C(/v2/deployments) per second, or with the event stream with I(wait_mode=events). Requires I(wait_timeout).
+
+  wait_healthy:
+    required: false
+    default: false
+    description:
+      - If C(yes) and I(wait_timeout) is set, also wait after the deployment until enough tasks of the app are healthy, or running for apps without health checks. The app is polled more often while tasks come up.
+
+  wait_healthy_fraction:
+    required: false
+    default: 1.0
+    description:
+      - The fraction of I(instances) that must be healthy for I(wait_healthy).
+
+  rate_limit:
+    required: false
+    default: 0
+    description:
+      - Maximum number of requests per second sent to Marathon, enforced with a token bucket. C(0) means no limit.
+      - The limit is per Marathon I(uri), and shared by all the module runs using the same I(rate_limit_file).
+
+  rate_burst:
+    required: false
+    default: null
+    description:
+      - Number of requests that can be sent at once, without waiting, before I(rate_limit) applies. Defaults to one second worth of requests.
+
+  max_deployments:
+    required: false
+    default: 0
+    description:
+      - Maximum number of deployments started by the module that can be in progress at once in Marathon. Requests that may start a deployment, on apps and groups, wait for a slot up to I(wait_timeout), or I(retry_deadline) without it. C(0) means no limit.
+      - Like I(rate_limit), it is shared between module runs through I(rate_limit_file).
+
+  rate_limit_file:
+    required: false
+    default: null
+    description:
+      - Path of a file, on the host running the module, where the state of I(rate_limit) and I(max_deployments) is shared between the module runs of all hosts and forks. Without it, the limits only apply within one module run.
+      - It must be different from I(leader_cache_file), I(app_cache_file) and I(token_cache_file).
+
+  retries:
+    required: false
+    default: 0
+    description:
+      - Number of times a request answered with one of the I(retry_statuses) is retried.
+      - On C(409), Marathon returns the deployments locking the app; they are waited for before the request is sent again, instead of interrupting them with I(force). Conflicts without deployments, like an app that already exists, are not retried.
+      - Other statuses, like C(503) during a leader election, are retried after an exponential backoff with jitter.
+
+  retry_delay:
+    required: false
+    default: 0.5
+    description:
+      - Base delay of the backoff between retries, in seconds. It doubles at each attempt, up to 30 seconds, and a random part of it is waited.
+
+  retry_deadline:
+    required: false
+    default: 300
+    description:
+      - Seconds after which a request is no longer retried, whatever is left of I(retries).
+
+  retry_statuses:
+    required: false
+    default: [409, 503]
+    description:
+      - HTTP statuses of the responses that are retried.
+
+  compression:
+    required: false
+    default: true
+    description:
+      - Ask Marathon for gzip compressed responses, which are decompressed transparently. App listings and large definitions shrink several times, which matters over slow links.
+
+  compress_requests:
+    required: false
+    default: 0
+    description:
+      - Request bodies of at least this many bytes are sent gzip compressed. C(0) never compresses them.
+      - Marathon, or the proxy in front of it, must accept compressed bodies. When it answers C(415), bodies are sent uncompressed for the rest of the run.
+
   validate_certs:
     description:
       - If C(no), SSL certificates will not be validated. This should only be
         set to C(no) when no other option exists.  Prior to 1.9.3 the code
         defaulted to C(no).
+      - Certificates are validated against the CA bundle of the system. Client certificates are not supported.
     required: false
     default: 'yes'
     choices: ['yes', 'no']
@@ -351,6 +662,93 @@ EXAMPLES = """
   async: 600
   poll: 1
 
+# Deploy several applications at once, waiting for all of them
+- name: Deploy the web stack using Marathon
+  marathon_app:
+    uri: "{{ marathon_url }}"
+    state: "present"
+    apps:
+      - id: "/web/frontend"
+        docker_image: "frontend:{{ version }}"
+        instances: 4
+      - id: "/web/backend"
+        docker_image: "backend:{{ version }}"
+        instances: 2
+    wait_timeout: 600
+
+# Deploy a whole group of applications as a single deployment
+- name: Deploy the billing service group using Marathon
+  marathon_app:
+    uri: "{{ marathon_url }}"
+    state: "present"
+    group:
+      id: "/team/billing"
+      apps:
+        - id: "db"
+          docker_image: "postgres:{{ postgres_version }}"
+        - id: "api"
+          docker_image: "billing-api:{{ version }}"
+          instances: 3
+          dependencies: [ "/team/billing/db" ]
+    wait_timeout: 900
+
+# Resize an application without sending its whole definition
+- name: Scale the frontend
+  marathon_app:
+    uri: "{{ marathon_url }}"
+    id: "/web/frontend"
+    state: "scaled"
+    instances: 10
+
+# Start the deployments of many apps without blocking, then wait for all of them
+- name: Deploy the workers
+  marathon_app:
+    uri: "{{ marathon_url }}"
+    id: "/workers/{{ item }}"
+    docker_image: "worker:{{ version }}"
+  with_items: "{{ workers }}"
+  register: workers_deployed
+
+- name: Wait for the workers
+  marathon_app:
+    uri: "{{ marathon_url }}"
+    state: "wait"
+    deployment_ids: "{{ workers_deployed.results | map(attribute='deployment_ids') | sum(start=[]) }}"
+    wait_timeout: 600
+
+# Drain an agent, waiting for the killed tasks to be replaced elsewhere
+- name: Drain agent
+  marathon_app:
+    uri: "{{ marathon_url }}"
+    state: "kill"
+    host: "{{ inventory_hostname }}"
+    wait_timeout: 300
+
+# Launch a fixed release of a crash looping app without waiting for its backoff
+- name: Deploy the fix
+  marathon_app:
+    uri: "{{ marathon_url }}"
+    id: "/my-app"
+    docker_image: "my-app:{{ fixed_version }}"
+    reset_delay: true
+
+# Show why the apps of a group are not launched
+- name: Inspect the launch queue
+  marathon_app:
+    uri: "{{ marathon_url }}"
+    state: "queue"
+    id: "/web"
+
+# Deploy the apps of the web group, removing the ones no longer in the inventory
+- name: Reconcile the web apps
+  marathon_app:
+    uri: "{{ marathon_url }}"
+    state: "reconcile"
+    prefix: "/web"
+    apps: "{{ web_apps }}"
+    max_deletions: 3
+    wait_timeout: 600
+
 # Remove an application from Marathon
 - name: Remove an old app from Marathon
   marathon_app:
@@ -361,10 +759,10 @@ EXAMPLES = """
 
 RETURN = """
 uri:
-    description: URI of the Marathon application
+    description: base URI of the Marathon instance the requests were sent to
     returned: success
     type: string
-    sample: /my-app
+    sample: http://marathon1.example.com:8080/
 state:
     description: state of the target, after execution
     returned: success
@@ -374,61 +772,836 @@ meta:
     description: additional information returned by Marathon, depends on the operation performed
     returned: success
     type: object
+http:
+    description: number of HTTP requests made to Marathon, connections opened and requests sent over an already open connection
+    returned: success
+    type: dict
+    sample: {"requests": 42, "connections": 1, "reused": 41, "retries": 0}
+tasks:
+    description: ids of the tasks killed
+    returned: when state is kill
+    type: list
+    sample: ["myapp.2f2a9d2e-6d4b-11e6-9d1b-0242ac110004"]
+queue:
+    description: instances waiting to be launched for each app, with the seconds left of their launch delay and the reasons offers were declined, most frequent first
+    returned: when state is queue
+    type: list
+    sample: [{"id": "/my-app", "count": 2, "delay": 1800.5, "overdue": false, "since": "2016-08-31T12:00:00.000Z", "reasons": [{"reason": "InsufficientMemory", "declined": 3}]}]
+reset:
+    description: apps whose launch delay was reset
+    returned: when state is queue
+    type: list
+    sample: ["/my-app"]
+deployment_ids:
+    description: ids of the deployments started by the module, to be waited for later with C(state=wait)
+    returned: always
+    type: list
+    sample: ["5ed4c0c5-9ff8-4a6f-a0cd-f57f59a34b43"]
+rollback:
+    description: when an update was rolled back with I(on_failure=rollback), the version restored, the deployments that failed and the rollback deployment
+    returned: failure
+    type: dict
+    sample: {"version": "2016-08-31T12:00:00.000Z", "failed_deployments": ["5ed4c0c5-9ff8-4a6f-a0cd-f57f59a34b43"], "deploymentId": "0b1a2c7e-7dd4-4b1e-9d34-3d1fb0d5b7a2"}
+deployments:
+    description: with C(state=wait), or when waiting for deployments failed, the outcome (success, failed or timeout) and the duration in seconds of each deployment
+    returned: when state is wait, or on failure waiting for deployments
+    type: dict
+    sample: {"5ed4c0c5-9ff8-4a6f-a0cd-f57f59a34b43": {"outcome": "success", "duration": 12.1}}
+timings:
+    description: time spent talking to Marathon, in seconds, overall and by endpoint, the bytes saved by compression, with the number of deployment polls, the total time spent waiting for deployments and the time spent waiting for I(rate_limit) and I(max_deployments)
+    returned: always
+    type: dict
+    sample: {"requests": 5, "request_time": 0.12, "bytes_sent": 812, "bytes_received": 4210, "endpoints": {"GET /v2/apps/{id}": {"count": 1, "time": 0.02, "max_time": 0.02}}, "wait_polls": 3, "wait_time": 2.1, "throttle_time": 0.0, "bytes_saved": 12630}
+plan:
+    description: in check mode, the operation that would be performed on each app (create, update, recreate, restart, kill, scale, delete or no-op) and the fields that would change
+    returned: check mode
+    type: list
+    sample: [{"id": "/my-app", "operation": "update", "fields": {"instances": {"before": 1, "after": 2}}}]
+apps:
+    description: per app result when I(apps) or I(group) is used, telling whether the app changed and which fields changed
+    returned: when apps or group is used
+    type: dict
+    sample: {"/web/frontend": {"changed": true, "fields": ["container"]}}
+groups:
+    description: groups whose own I(dependencies) or subgroups changed, and which of these fields changed
+    returned: when group is used with state present
+    type: dict
+    sample: {"/web": {"changed": true, "fields": ["dependencies"]}}
 """
 
 import base64
+import copy
+import cProfile
+import errno
+import fcntl
+import hashlib
+import math
+import os
+import random
+import re
+import select
+import socket
+import ssl
+import threading
 import traceback
+import uuid
+import zlib
+
+try:
+    import httplib
+    import Queue
+    from urllib import urlencode
+    from urlparse import urlparse
+except ImportError:
+    import http.client as httplib
+    import queue as Queue
+    from urllib.parse import urlencode, urlparse
+
+try:
+    import ijson
+    # use_float came with ijson 3.1, older versions return Decimal that Ansible cannot serialize
+    HAS_IJSON = tuple(int(x) for x in ijson.__version__.split('.')[:2]) >= (3, 1)
+except (ImportError, AttributeError, ValueError):
+    HAS_IJSON = False
+
+try:
+    import jwt
+    HAS_JWT = True
+except ImportError:
+    HAS_JWT = False
 
 MARATHON_APP_PARAMETERS = ['cmd', 'args', 'cpus', 'mem', 'disk', 'ports', 'requirePorts', 'portDefinitions', 'ipAddress', 'instances', 'executor', 'user', 'container', 'residency', 'env', 'constraints', 'acceptedResourceRoles', 'labels', 'uris', 'storeUrls', 'dependencies', 'fetch', 'healthChecks', 'readinessChecks', 'backoffSeconds', 'backoffFactor', 'maxLaunchDelaySeconds', 'upgradeStrategy', 'version', 'versionInfo']
 
-def request(url, user=None, passwd=None, data=None, method=None):
+# Fields that Marathon fills in by itself when they are left out of the definition
+MARATHON_SERVER_DEFAULTED = ['cpus', 'mem', 'instances', 'ports', 'portDefinitions', 'backoffSeconds', 'backoffFactor', 'maxLaunchDelaySeconds', 'upgradeStrategy']
+
+# Ports for which 0 means "assign a port dynamically"
+MARATHON_DYNAMIC_PORTS = ['/ports[]', '/portDefinitions[]/port', '/container/docker/portMappings[]/hostPort', '/container/docker/portMappings[]/servicePort']
+
+# Maps that are replaced as a whole, so keys missing from the definition are removed
+MARATHON_EXACT_MAPS = ['/env', '/labels']
+
+MARATHON_NETWORK_MODES = {'container/bridge': 'BRIDGE', 'host': 'HOST', 'container': 'USER'}
+
+class MarathonError(Exception):
+    def __init__(self, msg, **details):
+        Exception.__init__(self, msg)
+        self.msg = msg
+        self.details = details
+
+# Keep-alive connections reused for the lifetime of the module run, by thread, scheme, host and port
+CONNECTIONS = threading.local()
+
+HTTP_STATS = {'requests': 0, 'connections': 0, 'reused': 0, 'retries': 0}
+
+HTTP_LOCK = threading.Lock()
+
+HTTP_TIMEOUT = 10
+
+# Upper bound of the backoff between two retries, in seconds
+RETRY_DELAY_MAX = 30.0
+
+# Marathon endpoints, the one requests are sent to and the ones requests were moved from
+ENDPOINTS = {'uris': [], 'uri': None, 'moved': set()}
+
+# Seconds to wait for a rollback when no wait_timeout is given
+CANCEL_TIMEOUT = 600
+
+# Bounds of the interval between two polls of the app tasks, in seconds
+CAPACITY_POLL_MIN = 0.5
+CAPACITY_POLL_MAX = 5.0
+
+# Above this many apps to compare, listing all the apps is cheaper than fetching them one by one
+FINGERPRINT_FETCH_MAX = 20
+
+# Fields of the launch queue entries reported by the queue operation
+QUEUE_FIELDS = ['app.id', 'count', 'delay', 'since', 'processedOffersSummary.rejectSummaryLastOffers']
+
+# Requests which can be sent again when the connection broke before the response came
+IDEMPOTENT_METHODS = ['GET', 'HEAD']
+
+# Fields of an app needed to count its healthy tasks
+CAPACITY_FIELDS = ['instances', 'healthChecks', 'tasksHealthy', 'tasksRunning', 'tasksUnhealthy']
+
+AUTH_HEADERS = {}
+
+AUTH_TOKEN = {'token': None, 'issued': 0, 'expires': 0}
+
+AUTH_LOCK = threading.Lock()
+
+# Validity of the login token signed with the private key, and of tokens without an expiry we can read
+LOGIN_TOKEN_TTL = 300
+AUTH_TOKEN_TTL = 3600
+
+def loginUrls(params):
+    if params['login_url']:
+        return [params['login_url']]
+
+    # Login fails over like the other requests, starting with the instance in use
+    uris = ENDPOINTS['uris']
+    if ENDPOINTS['uri'] in uris:
+        start = uris.index(ENDPOINTS['uri'])
+        uris = uris[start:] + uris[:start]
+    urls = []
+    for uri in uris:
+        url = urlparse(uri)
+        urls.append('%s://%s/acs/api/v1/auth/login' % (url.scheme, url.netloc))
+    return urls
+
+def tokenExpiry(token):
+    # The expiry is read from the JWT claims, the signature is Marathon's business
+    try:
+        claims = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(str(claims + '=' * (-len(claims) % 4))).decode('utf-8'))
+        return float(claims['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + AUTH_TOKEN_TTL
+
+def login(params):
+    credentials = {'uid': params['principal']}
+    if params['private_key']:
+        with open(params['private_key']) as f:
+            key = f.read()
+        token = jwt.encode({'uid': params['principal'], 'exp': int(time.time()) + LOGIN_TOKEN_TTL}, key, algorithm='RS256')
+        credentials['token'] = token.decode('ascii') if isinstance(token, bytes) else token
+    else:
+        credentials['password'] = params['principal_password']
+
+    for url in loginUrls(params):
+        body, info = sendRequest(url, data=json.dumps(credentials), method='POST', headers={'Content-Type': 'application/json'})
+        if info['status'] != -1:
+            break
+    if info['status'] != 200:
+        raise MarathonError('Login as %s failed: %s' % (params['principal'], info['msg']), login_url=url)
+
+    token = json.loads(body)['token']
+    return {'token': token, 'issued': time.time(), 'expires': tokenExpiry(token)}
+
+def tokenValid(entry, params):
+    # Short lived tokens are renewed halfway through instead of at every request
+    refresh = min(params['token_refresh'], (entry['expires'] - entry.get('issued', 0)) / 2)
+    return entry['expires'] - refresh > time.time()
+
+def authenticate(params, rejected=None):
+    with AUTH_LOCK:
+        # Another thread may have logged in again already
+        if rejected is None:
+            if tokenValid(AUTH_TOKEN, params):
+                return
+        elif AUTH_TOKEN['token'] != rejected:
+            return
+
+        def update(entry):
+            if entry is not None and entry['token'] != rejected and tokenValid(entry, params):
+                return entry
+            return login(params)
+
+        if params['token_cache_file']:
+            entry = updateCacheFile(params['token_cache_file'], 'token ' + ' '.join(sorted(loginUrls(params))) + ' ' + params['principal'], update)
+        else:
+            entry = update(None)
+
+        AUTH_TOKEN.update(entry)
+        AUTH_HEADERS['Authorization'] = 'token=%s' % entry['token']
+
+def requestHeaders(user, passwd):
+    # Tokens are refreshed a little before they expire
+    if module.params['principal'] and not tokenValid(AUTH_TOKEN, module.params):
+        authenticate(module.params)
+
+    # The Authorization header is computed once per module run
+    if user is not None and 'Authorization' not in AUTH_HEADERS:
+        auth = base64.b64encode(('%s:%s' % (user, passwd)).encode('utf-8')).decode('ascii')
+        AUTH_HEADERS['Authorization'] = "Basic %s" % auth
+
+    headers = {'Content-Type': 'application/json'}
+    if module.params['compression']:
+        headers['Accept-Encoding'] = 'gzip'
+    headers.update(AUTH_HEADERS)
+    return headers
+
+def newConnection(url, timeout=HTTP_TIMEOUT):
+    if url.scheme == 'https':
+        context = ssl.create_default_context()
+        if not module.params['validate_certs']:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return httplib.HTTPSConnection(url.hostname, url.port, timeout=timeout, context=context)
+    return httplib.HTTPConnection(url.hostname, url.port, timeout=timeout)
+
+def connectionDropped(conn):
+    # Marathon closing an idle connection leaves the end of the stream to read
+    if conn.sock is None:
+        return False
+    try:
+        readable, writable, failed = select.select([conn.sock], [], [], 0)
+    except (ValueError, socket.error):
+        return True
+    return len(readable) > 0
+
+def urlPath(url):
+    if url.query:
+        return (url.path or '/') + '?' + url.query
+    return url.path or '/'
+
+TIMINGS = {'requests': 0, 'request_time': 0.0, 'bytes_sent': 0, 'bytes_received': 0, 'endpoints': {}, 'wait_polls': 0, 'wait_time': 0.0, 'throttle_time': 0.0, 'bytes_saved': 0}
+
+TRACE = {'file': None}
+
+COMPRESSION = {'rejected': False}
+
+# Deployments started during the module run
+STARTED_DEPLOYMENTS = []
+
+# Sub-resources kept when aggregating timings by endpoint
+MARATHON_SUBRESOURCES = ['restart', 'tasks', 'versions', 'delay', 'delete']
+
+def countRequest(stat, count=1):
+    with HTTP_LOCK:
+        HTTP_STATS[stat] += count
+
+def endpoint(method, path):
+    parts = path.split('?')[0].rstrip('/').split('/')
+    name = '/'.join(parts[:3])
+    if len(parts) > 3:
+        if parts[-1] in MARATHON_SUBRESOURCES:
+            name += '/{id}/' + parts[-1] if len(parts) > 4 else '/' + parts[-1]
+        else:
+            name += '/{id}'
+    return method + ' ' + name
+
+def traceRequest(method, url, status, sent, received, duration, saved=0):
+    name = endpoint(method, url.path)
+
+    with HTTP_LOCK:
+        TIMINGS['requests'] += 1
+        TIMINGS['request_time'] += duration
+        TIMINGS['bytes_sent'] += sent
+        TIMINGS['bytes_received'] += received
+        TIMINGS['bytes_saved'] += saved
+        stats = TIMINGS['endpoints'].setdefault(name, {'count': 0, 'time': 0.0, 'max_time': 0.0})
+        stats['count'] += 1
+        stats['time'] += duration
+        stats['max_time'] = max(stats['max_time'], duration)
+
+        if module.params['trace_file']:
+            if TRACE['file'] is None:
+                TRACE['file'] = open(module.params['trace_file'], 'a')
+            TRACE['file'].write(json.dumps({
+                'timestamp': time.time(), 'pid': os.getpid(), 'method': method, 'path': urlPath(url),
+                'status': status, 'bytes_sent': sent, 'bytes_received': received, 'bytes_saved': saved, 'duration': duration,
+            }) + '\n')
+            TRACE['file'].flush()
+
+def countWait(polls, duration):
+    with HTTP_LOCK:
+        TIMINGS['wait_polls'] += polls
+        TIMINGS['wait_time'] += duration
+
+class ResponseReader(object):
+
+    def __init__(self, response):
+        self.response = response
+        self.size = 0
+        self.decoded = 0
+        self.decoder = None
+        if response.getheader('Content-Encoding') == 'gzip':
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, size=-1):
+        while True:
+            data = self.response.read() if size is None or size < 0 else self.response.read(size)
+            self.size += len(data)
+            if self.decoder is not None:
+                chunk = data
+                data = self.decoder.decompress(chunk) if chunk else self.decoder.flush()
+                # Returning nothing before the end would be taken for the end of the body
+                if chunk and not data:
+                    continue
+            self.decoded += len(data)
+            return data
+
+def compressBody(data):
+    if isinstance(data, type(u'')):
+        data = data.encode('utf-8')
+    encoder = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return encoder.compress(data) + encoder.flush()
+
+def projectFields(value, paths):
+    if isinstance(value, list):
+        return [projectFields(x, paths) for x in value]
+    if not isinstance(value, dict):
+        return value
+
+    fields = {}
+    for path in paths:
+        key, _, rest = path.partition('.')
+        if not rest:
+            fields[key] = None
+        elif fields.get(key, []) is not None:
+            fields.setdefault(key, []).append(rest)
+
+    return dict((key, value[key] if sub is None else projectFields(value[key], sub)) for key, sub in fields.items() if key in value)
+
+def prefixItems(value, prefix):
+    values = [value]
+    for key in prefix.split('.') if prefix else []:
+        if key == 'item':
+            values = [x for v in values if isinstance(v, list) for x in v]
+        else:
+            values = [v[key] for v in values if isinstance(v, dict) and key in v]
+    return values
+
+def parseItems(stream, prefix, fields=None):
+    # Only the selected items are ever built, not the whole document
+    if HAS_IJSON:
+        items = ijson.items(stream, prefix, use_float=True)
+    else:
+        items = prefixItems(json.loads(stream.read()), prefix)
+
+    if fields:
+        return [projectFields(x, fields) for x in items]
+    return list(items)
+
+LIMITS = {}
+
+LIMITS_LOCK = threading.Lock()
+
+# Seconds after which a deployment slot is freed even if its deployment was never seen completing
+DEPLOYMENT_SLOT_TTL = 600
+
+# Methods of the requests on apps and groups that start a deployment
+DEPLOYMENT_METHODS = ['POST', 'PUT', 'PATCH', 'DELETE']
+
+def updateLimits(update):
+    # Limits are per Marathon, shared between module runs through the state file
+    key = 'limits ' + ','.join(ENDPOINTS['uris'])
+    if module.params['rate_limit_file']:
+        return updateCacheFile(module.params['rate_limit_file'], key, update)
+    with LIMITS_LOCK:
+        LIMITS[key] = update(LIMITS.get(key))
+        return LIMITS[key]
+
+def countThrottle(duration):
+    with HTTP_LOCK:
+        TIMINGS['throttle_time'] += duration
+
+def throttleRequest():
+    rate = module.params['rate_limit']
+    if not rate:
+        return
+    burst = module.params['rate_burst'] or max(1, int(math.ceil(rate)))
+
+    start = time.time()
+    while True:
+        delay = []
+
+        def update(entry):
+            entry = dict(entry or {})
+            now = time.time()
+            tokens = min(burst, entry.get('tokens', burst) + (now - entry.get('timestamp', now)) * rate)
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                delay.append((1 - tokens) / rate)
+            entry.update(tokens=tokens, timestamp=now)
+            return entry
+
+        updateLimits(update)
+        if not delay:
+            break
+        time.sleep(delay[0])
+
+    countThrottle(time.time() - start)
+
+def processAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+def releaseSlots(headers):
+    # Free the slots of the deployments Marathon completed and of the runs that died
+    ids, info = httpRequest(ENDPOINTS['uri'] + 'v2/deployments', headers=headers, parse=itemParser('item.id', None))
+    if info['status'] != 200:
+        return False
+    pending = set(ids)
+    released = []
+
+    def update(entry):
+        entry = dict(entry or {})
+        slots = entry.get('deployments', {})
+        entry['deployments'] = dict((k, v) for k, v in slots.items() if (v['deployment'] in pending if v.get('deployment') else processAlive(v['pid'])))
+        released.append(len(slots) - len(entry['deployments']))
+        return entry
+
+    updateLimits(update)
+    return released[0] > 0
+
+def startsDeployment(url, method):
+    # Canceling deployments and resetting launch delays must not wait behind the deployments they help
+    if method not in DEPLOYMENT_METHODS or not url.startswith(ENDPOINTS['uri'] or ''):
+        return False
+    path = urlparse(url).path[len(urlparse(ENDPOINTS['uri']).path):]
+    return re.match(r'^v2/(apps|groups)(/|$)', path) is not None
+
+def reserveDeployment(url, method, headers):
+    if not module.params['max_deployments'] or not startsDeployment(url, method):
+        return None
+
+    slot = '%d-%s' % (os.getpid(), uuid.uuid4().hex)
+    start = time.time()
+    deadline = start + (module.params['waitTimeout'] or module.params['retry_deadline'])
+    while True:
+        reserved = []
+
+        def update(entry):
+            entry = dict(entry or {})
+            now = time.time()
+            slots = dict((k, v) for k, v in entry.get('deployments', {}).items() if v['expires'] > now)
+            if len(slots) < module.params['max_deployments']:
+                slots[slot] = {'pid': os.getpid(), 'expires': now + DEPLOYMENT_SLOT_TTL}
+                reserved.append(slot)
+            entry['deployments'] = slots
+            return entry
+
+        updateLimits(update)
+        if reserved:
+            break
+
+        if time.time() >= deadline:
+            countThrottle(time.time() - start)
+            raise MarathonError('Timeout waiting for a deployment slot, max_deployments (%d) deployments are in progress.' % module.params['max_deployments'])
+
+        if not releaseSlots(headers):
+            time.sleep(1)
+
+    countThrottle(time.time() - start)
+    return slot
+
+def releaseDeployment(slot, ids):
+    if slot is None:
+        return
+
+    def update(entry):
+        entry = dict(entry or {})
+        slots = dict(entry.get('deployments', {}))
+        if ids:
+            # The slot is held until the deployment is seen completing
+            slots[slot] = dict(slots.get(slot, {'pid': os.getpid(), 'expires': time.time() + DEPLOYMENT_SLOT_TTL}), deployment=ids[0])
+        else:
+            slots.pop(slot, None)
+        entry['deployments'] = slots
+        return entry
+
+    updateLimits(update)
+
+def sendRequest(url, data=None, method=None, headers=None, parse=None):
+    throttleRequest()
+
+    url = urlparse(url)
+    key = (url.scheme, url.hostname, url.port)
+    if method is None:
+        method = 'POST' if data else 'GET'
+
+    if not hasattr(CONNECTIONS, 'pool'):
+        CONNECTIONS.pool = {}
+    pool = CONNECTIONS.pool
+
+    start = time.time()
+    while True:
+        body = data
+        sent = dict(headers or {})
+        threshold = module.params['compress_requests']
+        if data and threshold and len(data) >= threshold and not COMPRESSION['rejected']:
+            body = compressBody(data)
+            sent['Content-Encoding'] = 'gzip'
+        length = len(body or '')
+
+        reused = key in pool
+        if not reused:
+            pool[key] = newConnection(url)
+            countRequest('connections')
+        conn = pool[key]
+        if reused and connectionDropped(conn):
+            conn.close()
+
+        connected = False
+        try:
+            if conn.sock is None:
+                conn.connect()
+                # Headers and body are sent separately, do not let them wait for a delayed ACK
+                conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connected = True
+            conn.request(method, urlPath(url), body=body, headers=sent)
+            response = conn.getresponse()
+            reader = ResponseReader(response)
+            if parse is not None and response.status == 200:
+                body = parse(reader)
+                # Drain whatever was not parsed to keep the connection usable
+                reader.read()
+            else:
+                body = reader.read()
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            del pool[key]
+            # Marathon may have closed an idle connection, retry once on a new one unless
+            # the request could have been processed already, like a deployment started twice
+            if reused and method in IDEMPOTENT_METHODS:
+                continue
+            traceRequest(method, url, -1, length, 0, time.time() - start)
+            # Once connected, Marathon may have received and applied the request
+            return None, {'status': -1, 'msg': 'Request failed: %s' % e, 'url': url.geturl(), 'sent': connected}
+
+        saved = len(data or '') - length + reader.decoded - reader.size
+        traceRequest(method, url, response.status, length, reader.size, time.time() - start, saved)
+        countRequest('requests')
+        if reused:
+            countRequest('reused')
+        if response.will_close:
+            conn.close()
+            del pool[key]
+
+        if response.status == 415 and sent.get('Content-Encoding'):
+            # Marathon does not accept compressed bodies, stop sending them
+            COMPRESSION['rejected'] = True
+            continue
+
+        info = {'status': response.status, 'msg': 'HTTP %d: %s' % (response.status, response.reason), 'url': url.geturl()}
+        if parse is not None and response.status == 200:
+            info['parsed'] = True
+        if response.getheader('X-Marathon-Leader'):
+            info['leader'] = response.getheader('X-Marathon-Leader')
+        if response.status >= 400:
+            info['body'] = body
+        return body, info
+
+def baseUri(uri):
+    if not uri.endswith('/'):
+        uri = uri + '/'
+    return uri
+
+def leaderUri(endpoint, leader):
+    url = urlparse(endpoint)
+    if url.path not in ('', '/'):
+        # Behind a proxy path, the leader address is not reachable directly
+        return endpoint
+    if '://' in leader:
+        return baseUri(leader)
+    return '%s://%s/' % (url.scheme, leader)
+
+def switchEndpoint(uri):
+    with HTTP_LOCK:
+        if ENDPOINTS['uri'] != uri:
+            ENDPOINTS['moved'].add(ENDPOINTS['uri'])
+            ENDPOINTS['moved'].discard(uri)
+            ENDPOINTS['uri'] = uri
+
+def routeUrl(url):
+    for uri in ENDPOINTS['moved']:
+        if url.startswith(uri):
+            return ENDPOINTS['uri'] + url[len(uri):]
+    return url
+
+def findLeader(headers, exclude=None):
+    for endpoint in ENDPOINTS['uris']:
+        if endpoint == exclude:
+            continue
+        body, info = sendRequest(endpoint + 'v2/leader', headers=headers)
+        if info['status'] != 200:
+            continue
+        leader = leaderUri(endpoint, json.loads(body)['leader'])
+        # A leader that just failed may not be known as gone yet, use the endpoint itself
+        if leader == exclude:
+            return endpoint
+        return leader
+    return None
+
+def selectEndpoint(params, headers, exclude=None):
+    key = 'leader ' + ','.join(ENDPOINTS['uris'])
+
+    def update(entry):
+        if exclude is None and entry is not None and entry['timestamp'] + params['leader_cache_ttl'] > time.time():
+            return entry
+        leader = findLeader(headers, exclude)
+        if leader is None:
+            return None
+        return {'leader': leader, 'timestamp': time.time()}
+
+    if params['leader_cache_file']:
+        entry = updateCacheFile(params['leader_cache_file'], key, update)
+    else:
+        entry = update(None)
+
+    if entry is not None:
+        switchEndpoint(entry['leader'])
+        return True
+    return False
+
+def blockingDeployments(info):
+    try:
+        body = json.loads(info.get('body') or '{}')
+    except ValueError:
+        return []
+    if not isinstance(body, dict):
+        return []
+    return [x['id'] for x in body.get('deployments', []) if 'id' in x]
+
+def waitForBlocking(deploymentIds, deadline, headers):
+    start = time.time()
+    polls = 0
+    pending = set(deploymentIds)
+    try:
+        while pending and time.time() < deadline:
+            polls += 1
+            ids, info = httpRequest(ENDPOINTS['uri'] + 'v2/deployments', headers=headers, parse=itemParser('item.id', None))
+            if info['status'] == 200:
+                pending &= set(ids)
+            elif info['status'] == 404:
+                pending = set()
+            if pending:
+                time.sleep(min(1, max(0, deadline - time.time())))
+    finally:
+        countWait(polls, time.time() - start)
+
+def retryRequest(info, attempt, deadline, headers):
+    params = module.params
+    if attempt >= params['retries'] or info['status'] not in params['retry_statuses'] or time.time() >= deadline:
+        return False
+
+    if info['status'] == 409:
+        # Only an app locked by deployments gets unlocked by waiting
+        deploymentIds = blockingDeployments(info)
+        if not deploymentIds:
+            return False
+        waitForBlocking(deploymentIds, deadline, headers)
+    else:
+        # Exponential backoff with full jitter, so concurrent runs spread out
+        delay = random.uniform(0, min(RETRY_DELAY_MAX, params['retry_delay'] * 2 ** attempt))
+        time.sleep(min(delay, max(0, deadline - time.time())))
+
+    countRequest('retries')
+    return True
+
+def httpRequest(url, data=None, method=None, headers=None, parse=None):
+    attempt = 0
+    deadline = time.time() + (module.params['retry_deadline'] or 0)
+    renewed = False
+    while True:
+        body, info = failoverRequest(url, data=data, method=method, headers=headers, parse=parse)
+
+        # The token may have been revoked or expired earlier than announced, log in again once
+        if info['status'] == 401 and module.params['principal'] and not renewed and headers:
+            renewed = True
+            authenticate(module.params, rejected=AUTH_TOKEN['token'])
+            headers['Authorization'] = AUTH_HEADERS['Authorization']
+            continue
+
+        if not retryRequest(info, attempt, deadline, headers):
+            return body, info
+        attempt += 1
+
+def failoverRequest(url, data=None, method=None, headers=None, parse=None):
+    failovers = 0
+    while True:
+        url = routeUrl(url)
+        body, info = sendRequest(url, data=data, method=method, headers=headers, parse=parse)
+
+        uri = ENDPOINTS['uri']
+        if not uri or not url.startswith(uri):
+            return body, info
+
+        # Marathon tells which instance leads, follow it when it changed
+        if module.params['leader_discovery'] and info.get('leader') and leaderUri(uri, info['leader']) != uri:
+            switchEndpoint(leaderUri(uri, info['leader']))
+
+        # Fail over to another endpoint when Marathon is not reachable, but do not send
+        # again a request that may have started a deployment already
+        if info['status'] != -1 or failovers >= len(ENDPOINTS['uris']) - 1:
+            return body, info
+        if info.get('sent') and (method or ('POST' if data else 'GET')) not in IDEMPOTENT_METHODS:
+            return body, info
+        failovers += 1
+        if module.params['leader_discovery']:
+            if not selectEndpoint(module.params, headers, exclude=uri):
+                return body, info
+        else:
+            switchEndpoint(ENDPOINTS['uris'][(ENDPOINTS['uris'].index(uri) + 1) % len(ENDPOINTS['uris'])])
+
+def openStream(url, headers, timeout):
+    # Streams are long-lived, they get their own connection
+    url = urlparse(routeUrl(url))
+    conn = newConnection(url, timeout)
+    try:
+        conn.request('GET', urlPath(url), headers=headers)
+        response = conn.getresponse()
+    except (httplib.HTTPException, socket.error) as e:
+        conn.close()
+        return None, {'status': -1, 'msg': 'Request failed: %s' % e, 'url': url.geturl()}
+
+    countRequest('connections')
+    return response, {'status': response.status, 'msg': response.reason, 'url': url.geturl()}
+
+def recordDeployments(body, method):
+    if method in (None, 'GET') or not isinstance(body, dict):
+        return []
+
+    ids = [x['id'] for x in body.get('deployments', []) if 'id' in x]
+    if 'deploymentId' in body:
+        ids.append(body['deploymentId'])
+
+    with HTTP_LOCK:
+        for id in ids:
+            if id not in STARTED_DEPLOYMENTS:
+                STARTED_DEPLOYMENTS.append(id)
+    return ids
+
+def itemParser(items, fields):
+    if items is None:
+        return None
+    return lambda stream: parseItems(stream, items, fields)
+
+def jsonRequest(url, user, passwd, data, method, items, fields):
+    headers = requestHeaders(user, passwd)
+    slot = reserveDeployment(url, method, headers)
+    ids = []
+    try:
+        raw_body, info = httpRequest(url, data=data, method=method, headers=headers, parse=itemParser(items, fields))
+
+        body = {}
+
+        if info['status'] in (200, 201, 204):
+            if info.get('parsed'):
+                body = raw_body
+            elif raw_body:
+                body = json.loads(raw_body)
+                ids = recordDeployments(body, method)
+
+        return (body, info)
+    finally:
+        releaseDeployment(slot, ids)
+
+def request(url, user=None, passwd=None, data=None, method=None, items=None, fields=None):
     if data:
         data = json.dumps(data)
 
-    if user is not None:
-        auth = base64.encodestring('%s:%s' % (user, passwd)).replace('\n', '')
-        response, info = fetch_url(module, url, data=data, method=method,
-                                   headers={'Content-Type':'application/json',
-                                            'Authorization':"Basic %s" % auth})
-    else:
-        response, info = fetch_url(module, url, data=data, method=method,
-                                   headers={'Content-Type':'application/json'})
+    body, info = jsonRequest(url, user, passwd, data, method, items, fields)
 
     if info['status'] not in (200, 201, 204):
         msg = info['msg']
+        body = {}
         if data:
             msg = msg + ' ' + data
-            body = {}
-        if 'body' in info:
+        if info.get('body'):
             body = json.loads(info['body'])
 
-        module.fail_json(msg=msg, response=body, data=data)
+        raise MarathonError(msg, response=body, data=data)
 
-    body = response.read()
+    return body
 
-    if body:
-        return json.loads(body)
-    else:
-        return {}
-
-def tryRequest(url, user=None, passwd=None, data=None, method=None):
-    if user is not None:
-        auth = base64.encodestring('%s:%s' % (user, passwd)).replace('\n', '')
-        response, info = fetch_url(module, url, data=data, method=method,
-                                   headers={'Content-Type':'application/json',
-                                            'Authorization':"Basic %s" % auth})
-    else:
-        response, info = fetch_url(module, url, data=data, method=method,
-                                   headers={'Content-Type':'application/json'})
-
-    body = {}
-
-    if info['status'] in (200, 201, 204):
-        raw_body = response.read()
-        if raw_body:
-            body = json.loads(raw_body)
-
-    return (body, info)
+def tryRequest(url, user=None, passwd=None, data=None, method=None, items=None, fields=None):
+    return jsonRequest(url, user, passwd, data, method, items, fields)
 
 def post(url, user, passwd, data):
     return request(url, user, passwd, data=data, method='POST')
@@ -436,8 +1609,8 @@ def post(url, user, passwd, data):
 def put(url, user, passwd, data):
     return request(url, user, passwd, data=data, method='PUT')
 
-def get(url, user, passwd):
-    return request(url, user, passwd)
+def get(url, user, passwd, items=None, fields=None):
+    return request(url, user, passwd, items=items, fields=fields)
 
 def delete(url, user, passwd, params):
     ret, info = tryRequest(url, user, passwd, data=None, method='DELETE')
@@ -446,7 +1619,7 @@ def delete(url, user, passwd, params):
         result['deploymentId'] = ret['deploymentId']
     return result
 
-def create(restbase, user, passwd, params):
+def buildApp(params):
     data = {'id': params['id']}
 
     # Merge in any additional or overridden fields
@@ -454,53 +1627,566 @@ def create(restbase, user, passwd, params):
         if params[arg]:
             data.update({arg: params[arg]})
 
+    # Zero instances suspends the app
+    if params['instances'] == 0:
+        data['instances'] = 0
+
+    label = params['fingerprint_label']
+    if label:
+        labels = dict(data.get('labels') or {})
+        labels[label] = appFingerprint(data, label)
+        data['labels'] = labels
+
+    return data
+
+def withoutLabel(labels, label):
+    return dict((k, v) for k, v in (labels or {}).items() if k != label)
+
+def appFingerprint(data, label):
+    # Instances change by scaling without the label, they are always compared instead
+    canonical = dict((k, v) for k, v in data.items() if k not in ('id', 'instances'))
+    if 'labels' in canonical:
+        canonical['labels'] = withoutLabel(canonical['labels'], label)
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def isEmpty(value):
+    return value in (None, 0, '', [], {})
+
+def normalizeApp(app):
+    app = dict(app)
+
+    # Marathon 1.5+ moved the Docker networking settings out of container.docker
+    container = app.get('container')
+    if container and 'docker' in container:
+        container = dict(container)
+        docker = dict(container['docker'] or {})
+        if 'portMappings' in container and not docker.get('portMappings'):
+            docker['portMappings'] = container['portMappings']
+        if 'network' not in docker and app.get('networks'):
+            mode = app['networks'][0].get('mode')
+            docker['network'] = MARATHON_NETWORK_MODES.get(mode, mode)
+        container['docker'] = docker
+        app['container'] = container
+
+    return app
+
+def sameValue(desired, current, path=''):
+    if isEmpty(desired) and isEmpty(current):
+        return True
+
+    if isinstance(desired, dict):
+        if not isinstance(current, dict):
+            return False
+        if path in MARATHON_EXACT_MAPS and set(desired) != set(current):
+            return False
+        # Keys only present on the Marathon side are server-filled defaults
+        for key, value in desired.items():
+            if not sameValue(value, current.get(key), path + '/' + key):
+                return False
+        return True
+
+    if isinstance(desired, list):
+        if not isinstance(current, list) or len(desired) != len(current):
+            return False
+        for d, c in zip(desired, current):
+            if not sameValue(d, c, path + '[]'):
+                return False
+        return True
+
+    # Port 0 asks Marathon to pick a port, any assigned value is a match
+    if path in MARATHON_DYNAMIC_PORTS and desired == 0:
+        return True
+
+    # Marathon stores environment values as strings
+    if path.startswith('/env/'):
+        return current is not None and '%s' % desired == '%s' % current
+
+    if isinstance(desired, bool) or isinstance(current, bool):
+        return desired == current
+
+    if isinstance(desired, (int, float)) and isinstance(current, (int, float)):
+        return float(desired) == float(current)
+
+    return desired == current
+
+def appDiff(desired, current):
+    label = module.params['fingerprint_label']
+    if label:
+        fingerprint = (desired.get('labels') or {}).get(label)
+        if fingerprint and (current.get('labels') or {}).get(label) == fingerprint:
+            desired = dict((k, v) for k, v in desired.items() if k == 'instances')
+            current = {'instances': current.get('instances')}
+
+    current = normalizeApp(current)
+    diff = {}
+
+    for arg in MARATHON_APP_PARAMETERS:
+        if arg in ('version', 'versionInfo'):
+            continue
+        if arg not in desired and arg in MARATHON_SERVER_DEFAULTED:
+            continue
+        if arg == 'labels' and label:
+            # A fingerprint alone is not worth a new app version
+            if sameValue(withoutLabel(desired.get(arg), label), withoutLabel(current.get(arg), label), '/' + arg):
+                continue
+        if not sameValue(desired.get(arg), current.get(arg), '/' + arg):
+            diff[arg] = {'before': current.get(arg), 'after': desired.get(arg)}
+
+    # An explicit version asks Marathon to roll back to it
+    if desired.get('version') and desired['version'] != current.get('version'):
+        diff['version'] = {'before': current.get('version'), 'after': desired['version']}
+
+    return diff
+
+# Snapshot of the apps deployed in Marathon, read once per module run
+APP_CACHE = {'apps': None, 'stale': set()}
+
+APP_CACHE_LOCK = threading.Lock()
+
+def appCacheQuery(params):
+    query = [('embed', 'apps.deployments')]
+    if params['app_cache_id']:
+        query.append(('id', params['app_cache_id']))
+    if params['app_cache_label']:
+        query.append(('label', params['app_cache_label']))
+    return '?' + urlencode(query)
+
+def updateCacheFile(path, key, update):
+    # Serialize concurrent module runs on the control node
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            cache = {}
+
+        entry = update(cache.get(key))
+        if entry is not None:
+            cache[key] = entry
+            tmp = path + '.tmp'
+            # Cache files may hold authentication tokens
+            with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump(cache, f)
+            os.rename(tmp, path)
+        return entry
+
+def loadAppCache(restbase, user, passwd, params):
+    with APP_CACHE_LOCK:
+        if APP_CACHE['apps'] is not None:
+            return
+
+        query = appCacheQuery(params)
+        key = 'apps ' + restbase + query
+
+        def update(entry):
+            if entry is not None and entry['timestamp'] + params['app_cache_ttl'] > time.time():
+                return entry
+            apps = get(restbase + '/apps' + query, user, passwd).get('apps', [])
+            return {'timestamp': time.time(), 'apps': dict((x['id'], x) for x in apps), 'stale': []}
+
+        if params['app_cache_file']:
+            entry = updateCacheFile(params['app_cache_file'], key, update)
+        else:
+            entry = update(None)
+
+        APP_CACHE['key'] = key
+        APP_CACHE['apps'] = entry['apps']
+        APP_CACHE['stale'].update(entry['stale'])
+
+def invalidateAppCache(params, ids):
+    if not params['app_cache']:
+        return
+
+    with APP_CACHE_LOCK:
+        APP_CACHE['stale'].update(ids)
+        if APP_CACHE['apps'] is None or not params['app_cache_file']:
+            return
+
+        def update(entry):
+            if entry is not None:
+                entry['stale'] = sorted(set(entry['stale']) | set(ids))
+            return entry
+
+        updateCacheFile(params['app_cache_file'], APP_CACHE['key'], update)
+
+def appCached(params, id):
+    if id in APP_CACHE['stale']:
+        return False
+    if id in APP_CACHE['apps']:
+        return True
+    # Only a filter on ids tells which missing apps really do not exist
+    return not params['app_cache_label'] and (params['app_cache_id'] or '') in id
+
+def fetchApp(restbase, user, passwd, params, id):
+    id = appId(id)
+    if params['app_cache']:
+        loadAppCache(restbase, user, passwd, params)
+        # Deployments seen in the snapshot may be over by now, never act on them without asking Marathon
+        if appCached(params, id) and not (APP_CACHE['apps'].get(id) or {}).get('deployments'):
+            if id in APP_CACHE['apps']:
+                return {'app': APP_CACHE['apps'][id]}, {'status': 200, 'msg': 'OK (cached)'}
+            return {}, {'status': 404, 'msg': 'App %s does not exist (cached)' % id}
+
+    return tryRequest(restbase + '/apps' + id, user, passwd)
+
+def fetchApps(restbase, user, passwd, params, ids):
+    if not params['app_cache'] and (not params['fingerprint_label'] or len(ids) > FINGERPRINT_FETCH_MAX):
+        current = get(restbase + '/apps', user, passwd)
+        return dict((x['id'], x) for x in current.get('apps', []))
+
+    index = {}
+    for id in ids:
+        app, info = fetchApp(restbase, user, passwd, params, id)
+        if info['status'] in (200, 204):
+            index[id] = app['app']
+    return index
+
+def fetchFingerprints(restbase, user, passwd, params):
+    label = params['fingerprint_label']
+    url = restbase + '/apps?' + urlencode({'label': label})
+    apps = get(url, user, passwd, items='apps.item', fields=['id', 'labels', 'instances'])
+    return dict((x['id'], x) for x in apps)
+
+def newAppDiff(data):
+    return dict((arg, {'before': None, 'after': data[arg]}) for arg in data)
+
+def planApp(params, state, current):
+    item = {'id': appId(params['id']), 'operation': 'no-op', 'fields': {}}
+
+    if state == 'absent':
+        if current is not None:
+            item['operation'] = 'delete'
+        return item
+
+    if current is None:
+        if state != 'present':
+            raise MarathonError('App %s does not exist' % item['id'])
+        item['operation'] = 'create'
+        item['fields'] = newAppDiff(buildApp(params))
+        return item
+
+    if state == 'restart':
+        item['operation'] = 'restart'
+    elif state == 'kill':
+        if current.get('tasksRunning'):
+            item['operation'] = 'kill'
+    elif state == 'scaled':
+        if current['instances'] != params['instances']:
+            item['operation'] = 'scale'
+            item['fields'] = {'instances': {'before': current['instances'], 'after': params['instances']}}
+    else:
+        item['fields'] = appDiff(buildApp(params), current)
+        if current.get('deployments'):
+            item['operation'] = 'recreate' if params['stuck_deployment'] == 'recreate' else 'update'
+            item['cancel_deployments'] = [x['id'] for x in current['deployments']]
+        elif item['fields']:
+            item['operation'] = 'update'
+
+    return item
+
+def plan(restbase, user, passwd, params, state):
+    if params['group']:
+        if state == 'absent':
+            id = groupId(params['group'].get('id') or params['id'], '/')
+            current, info = tryRequest(restbase + '/groups' + id, user, passwd)
+            changes = dict((x, ('delete', {})) for x in groupApps(current))
+        else:
+            data, current, changes, groups = groupChanges(restbase, user, passwd, params)
+            for id, diff in groups.items():
+                changes[id] = ('update', diff)
+        items = [{'id': id, 'operation': op, 'fields': diff} for id, (op, diff) in sorted(changes.items())]
+    elif state == 'reconcile':
+        desired, changes = reconcileChanges(restbase, user, passwd, params)
+        items = [{'id': id, 'operation': op, 'fields': diff} for id, (op, diff) in sorted(changes.items())]
+    elif state == 'kill' and (params['host'] or params['task_ids']):
+        tasks = {}
+        for task in findTasks(restbase, user, passwd, params):
+            tasks.setdefault(appId(task['appId']), []).append(task['id'])
+        items = [{'id': id, 'operation': 'kill', 'fields': {}, 'tasks': sorted(ids)} for id, ids in sorted(tasks.items())]
+    else:
+        if params['apps']:
+            apps = [appParams(params, app) for app in params['apps']]
+            index = fetchApps(restbase, user, passwd, params, [appId(app['id']) for app in apps])
+        else:
+            apps = [params]
+            app, info = fetchApp(restbase, user, passwd, params, params['id'])
+            index = {}
+            if info['status'] in (200, 204):
+                index[appId(params['id'])] = app['app']
+        items = [planApp(app, state, index.get(appId(app['id']))) for app in apps]
+
+    changed = [item for item in items if item['operation'] != 'no-op']
+    diff = {
+        'before': dict((item['id'], dict((k, v['before']) for k, v in item['fields'].items())) for item in changed),
+        'after': dict((item['id'], dict((k, v['after']) for k, v in item['fields'].items())) for item in changed),
+    }
+
+    return {'meta': {}, 'changed': len(changed) > 0, 'plan': items, 'diff': diff}
+
+def create(restbase, user, passwd, params):
+    data = buildApp(params)
+
     url = restbase + '/apps'
 
     ret = post(url, user, passwd, data)
+    invalidateAppCache(params, [appId(params['id'])])
+    resetDelays(restbase, user, passwd, params, [params['id']])
 
     if params['waitTimeout']:
-        waitForDeployment(restbase, user, passwd, params, ret['deployments'][0]['id'])
+        waitForApps(restbase, user, passwd, params, [ret['deployments'][0]['id']], [params['id']])
 
     return {'meta': ret, 'changed': True}
 
 def edit(restbase, user, passwd, params):
-    data = {'id': params['id']}
-
-    # Merge in any additional or overridden fields
-    for arg in MARATHON_APP_PARAMETERS:
-        if params[arg]:
-            data.update({arg: params[arg]})
+    data = buildApp(params)
 
     url = restbase + '/apps/' + params['id'] + '?force=' + str(params['force']).lower()
 
     ret = put(url, user, passwd, data)
+    invalidateAppCache(params, [appId(params['id'])])
+    resetDelays(restbase, user, passwd, params, [params['id']])
 
     if params['waitTimeout']:
-        waitForDeployment(restbase, user, passwd, params, ret['deploymentId'])
+        waitForApps(restbase, user, passwd, params, [ret['deploymentId']], [params['id']])
 
     return {'meta': ret, 'changed': 'deploymentId' in ret}
 
-def waitForDeployment(restbase, user, passwd, params, deploymentId):
-    timeout = time.time() + params['waitTimeout']
+def partialUpdate(restbase, user, passwd, params, url, data):
+    ret, info = tryRequest(url, user, passwd, data=json.dumps(data), method='PATCH')
 
-    while True:
-        url = restbase + '/deployments'
-        deployments, info = tryRequest(url, user, passwd)
+    if info['status'] == 405:
+        # Marathon before 1.5 has no PATCH, PUT only changes the fields given there
+        ret = put(url + '&partialUpdate=true', user, passwd, data)
+    elif info['status'] not in (200, 201, 204):
+        raise MarathonError(info['msg'], data=data)
 
-        if info['status'] == 404:
-          return
+    return ret
 
-        if info['status'] in (200, 201, 204):
-            deploymentIds = map(lambda x: x['id'], deployments)
-            if deploymentId not in deploymentIds:
+def patch(restbase, user, passwd, params, data):
+    url = restbase + '/apps/' + params['id'] + '?force=' + str(params['force']).lower()
+
+    ret = partialUpdate(restbase, user, passwd, params, url, data)
+    invalidateAppCache(params, [appId(params['id'])])
+    resetDelays(restbase, user, passwd, params, [params['id']])
+
+    if params['waitTimeout'] and 'deploymentId' in ret:
+        waitForApps(restbase, user, passwd, params, [ret['deploymentId']], [params['id']])
+
+    return {'meta': ret, 'changed': 'deploymentId' in ret}
+
+def readEvents(response, timeout):
+    data = []
+    # The socket timeout only covers silences, events of other deployments keep the stream alive
+    while time.time() < timeout:
+        line = response.readline()
+        if not line:
+            return
+        if not isinstance(line, str):
+            line = line.decode('utf-8')
+        line = line.rstrip('\r\n')
+        if line.startswith('data:'):
+            data.append(line[5:].strip())
+        elif not line and data:
+            yield json.loads('\n'.join(data))
+            data = []
+
+def pendingDeployments(restbase, user, passwd, deploymentIds):
+    url = restbase + '/deployments'
+    ids, info = tryRequest(url, user, passwd, items='item.id')
+
+    if info['status'] == 404:
+        return set()
+
+    if info['status'] in (200, 201, 204):
+        return set(deploymentIds) & set(ids or [])
+
+    return set(deploymentIds)
+
+def waitForDeploymentEvents(restbase, user, passwd, params, deploymentIds, timeout, finish, stopOnFailure):
+    url = restbase + '/events?event_type=deployment_success&event_type=deployment_failed'
+    headers = requestHeaders(user, passwd)
+    headers['Accept'] = 'text/event-stream'
+    headers.pop('Accept-Encoding', None)
+
+    response, info = openStream(url, headers, max(1, timeout - time.time()))
+
+    if info['status'] != 200:
+        if response is not None:
+            response.close()
+        return deploymentIds
+
+    # Deployments may have completed before we subscribed to the stream
+    pending = pendingDeployments(restbase, user, passwd, deploymentIds)
+    finish(set(deploymentIds) - pending, 'success')
+
+    events = readEvents(response, timeout)
+    try:
+        while pending:
+            event = next(events, None)
+            if event is None:
+                break
+            eventId = event.get('id') or event.get('plan', {}).get('id')
+            if eventId not in pending:
+                continue
+            pending.discard(eventId)
+            if event.get('eventType') == 'deployment_failed':
+                finish([eventId], 'failed')
+                if stopOnFailure:
+                    break
+            else:
+                finish([eventId], 'success')
+    except (IOError, ValueError):
+        # Timeouts and broken streams are handled by polling
+        pass
+    finally:
+        response.close()
+
+    return pending
+
+def trackDeployments(restbase, user, passwd, params, deploymentIds, stopOnFailure=True):
+    start = time.time()
+    polls = 0
+    outcomes = {}
+
+    def finish(ids, outcome):
+        for id in ids:
+            outcomes[id] = {'outcome': outcome, 'duration': time.time() - start}
+
+    try:
+        timeout = start + params['waitTimeout']
+        pending = set(deploymentIds)
+
+        if params['wait_mode'] == 'events':
+            pending = waitForDeploymentEvents(restbase, user, passwd, params, pending, timeout, finish, stopOnFailure)
+            if stopOnFailure and [x for x in outcomes.values() if x['outcome'] == 'failed']:
+                return outcomes
+
+        while pending:
+            polls += 1
+            remaining = pendingDeployments(restbase, user, passwd, pending)
+            finish(pending - remaining, 'success')
+            pending = remaining
+            if not pending:
+                break
+
+            time.sleep(1)
+
+            if time.time() > timeout:
+                finish(pending, 'timeout')
+                break
+    finally:
+        countWait(polls, time.time() - start)
+
+    return outcomes
+
+def waitForDeployments(restbase, user, passwd, params, deploymentIds):
+    outcomes = trackDeployments(restbase, user, passwd, params, deploymentIds)
+
+    failed = sorted(id for id, x in outcomes.items() if x['outcome'] == 'failed')
+    if failed:
+        raise MarathonError('Deployment %s failed.' % ', '.join(failed), deployments=outcomes)
+
+    pending = sorted(id for id, x in outcomes.items() if x['outcome'] == 'timeout')
+    if pending:
+        raise MarathonError('Timeout waiting for deployment.', deployments=outcomes)
+
+def waitForDeployment(restbase, user, passwd, params, deploymentId):
+    waitForDeployments(restbase, user, passwd, params, [deploymentId])
+
+def waitForCapacity(restbase, user, passwd, params, appIds, timeout):
+    start = time.time()
+    polls = 0
+    interval = CAPACITY_POLL_MIN
+    healthy = {}
+    pending = set(appIds)
+    try:
+        while True:
+            progress = False
+            for id in sorted(pending):
+                polls += 1
+                ret, info = tryRequest(restbase + '/apps' + id + '?embed=app.counts', user, passwd, items='app', fields=CAPACITY_FIELDS)
+                if info['status'] != 200 or not ret:
+                    continue
+                app = ret[0]
+
+                # Without health checks, running tasks are all Marathon knows about
+                if app.get('healthChecks'):
+                    count = app['tasksHealthy']
+                else:
+                    count = app['tasksRunning'] - app.get('tasksUnhealthy', 0)
+                if count > healthy.get(id, 0):
+                    progress = True
+                healthy[id] = count
+
+                if count >= math.ceil(params['wait_healthy_fraction'] * app['instances']):
+                    pending.discard(id)
+
+            if not pending:
                 return
 
-        time.sleep(1)
+            if time.time() > timeout:
+                raise MarathonError('Timeout waiting for healthy tasks.', apps=sorted(pending), healthy=healthy)
+
+            # Poll quickly while tasks come up, back off while nothing moves
+            interval = CAPACITY_POLL_MIN if progress else min(interval * 1.5, CAPACITY_POLL_MAX)
+            time.sleep(min(interval, max(0, timeout - time.time())))
+    finally:
+        countWait(polls, time.time() - start)
+
+def waitForKilled(restbase, user, passwd, params, tasks, timeout):
+    start = time.time()
+    polls = 0
+    pending = {}
+    for task in tasks:
+        pending.setdefault(appId(task['appId']), set()).add(task['id'])
+    try:
+        while True:
+            for id in sorted(pending):
+                polls += 1
+                ids, info = tryRequest(restbase + '/apps' + id + '/tasks', user, passwd, items='tasks.item.id')
+                if info['status'] == 404:
+                    del pending[id]
+                elif info['status'] == 200:
+                    pending[id] &= set(ids)
+                    if not pending[id]:
+                        del pending[id]
+
+            if not pending:
+                return
+
+            if time.time() > timeout:
+                raise MarathonError('Timeout waiting for the tasks to be killed.', tasks=sorted(set().union(*pending.values())))
+
+            time.sleep(min(CAPACITY_POLL_MIN, max(0, timeout - time.time())))
+    finally:
+        countWait(polls, time.time() - start)
+
+def waitForApps(restbase, user, passwd, params, deploymentIds, appIds):
+    timeout = time.time() + params['waitTimeout']
+    waitForDeployments(restbase, user, passwd, params, deploymentIds)
+    if params['wait_healthy']:
+        waitForCapacity(restbase, user, passwd, params, [appId(id) for id in appIds], timeout)
+
+def cancelDeployments(restbase, user, passwd, params, deploymentIds):
+    force = params['stuck_deployment'] == 'cancel'
+    rollbacks = []
 
-        if time.time() > timeout:
-            module.fail_json(msg='Timeout waiting for deployment.')
+    for deploymentId in deploymentIds:
+        url = restbase + '/deployments/' + deploymentId + '?force=' + str(force).lower()
+        ret, info = tryRequest(url, user, passwd, method='DELETE')
 
-    return
+        # Without force, Marathon starts a deployment rolling back to the previous version
+        if info['status'] == 200 and 'deploymentId' in ret:
+            rollbacks.append(ret['deploymentId'])
+        elif info['status'] not in (202, 204, 404):
+            raise MarathonError('Cannot cancel deployment %s: %s' % (deploymentId, info['msg']))
+
+    if rollbacks:
+        waitParams = dict(params, waitTimeout=params['waitTimeout'] or CANCEL_TIMEOUT)
+        waitForDeployments(restbase, user, passwd, waitParams, rollbacks)
+
+    return rollbacks
 
 def restart(restbase, user, passwd, params):
     data = {
@@ -512,13 +2198,14 @@ def restart(restbase, user, passwd, params):
     ret = post(url, user, passwd, data)
 
     if params['waitTimeout']:
-        waitForDeployment(restbase, user, passwd, params, ret['deployments'][0]['id'])
+        waitForApps(restbase, user, passwd, params, [ret['deployments'][0]['id']], [params['id']])
 
     return {'meta': ret, 'changed': True}
 
 def fetch(restbase, user, passwd, params):
-    url = restbase + '/apps/' + params['id']
-    ret = get(url, user, passwd)
+    ret, info = fetchApp(restbase, user, passwd, params, params['id'])
+    if info['status'] not in (200, 201, 204):
+        raise MarathonError(info['msg'], response=ret)
     return ret
 
 def versions(restbase, user, passwd, params):
@@ -529,6 +2216,7 @@ def versions(restbase, user, passwd, params):
 def destroy(restbase, user, passwd, params):
     url = restbase + '/apps/' + params['id']
     ret = delete(url, user, passwd, params)
+    invalidateAppCache(params, [appId(params['id'])])
     if params['waitTimeout'] and ret['changed']:
         waitForDeployment(restbase, user, passwd, params, ret['deploymentId'])
         ret.pop('deploymentId', None)
@@ -537,104 +2225,821 @@ def destroy(restbase, user, passwd, params):
 def absent(restbase, user, passwd, params):
     return destroy(restbase, user, passwd, params)
 
+def previousVersion(restbase, user, passwd, params, app):
+    # The version running before the update, unless it was still being deployed itself
+    if not app.get('deployments'):
+        return app['version']
+    older = [x for x in versions(restbase, user, passwd, params).get('versions', []) if x < app['version']]
+    if older:
+        return older[0]
+    return None
+
+def rollback(restbase, user, passwd, params, previous, error):
+    id = appId(params['id'])
+    current, info = tryRequest(restbase + '/apps' + id, user, passwd)
+    if info['status'] != 200 or current['app']['version'] == previous:
+        # The update never reached Marathon, there is nothing to roll back
+        raise error
+
+    # Stop the failing deployment where it is, the previous version replaces it
+    pending = [x['id'] for x in current['app'].get('deployments', [])]
+    cancelDeployments(restbase, user, passwd, dict(params, stuck_deployment='cancel'), pending)
+
+    ret = put(restbase + '/apps' + id + '?force=true', user, passwd, {'version': previous})
+    invalidateAppCache(params, [id])
+
+    details = dict(error.details)
+    details['rollback'] = {
+        'version': previous,
+        'failed_deployments': sorted(set(pending) | set(id for id, x in (error.details.get('deployments') or {}).items() if x['outcome'] != 'success')),
+        'deploymentId': ret['deploymentId'],
+    }
+    try:
+        waitForApps(restbase, user, passwd, params, [ret['deploymentId']], [id])
+    except MarathonError as e:
+        raise MarathonError('%s Rolling back to version %s failed too: %s' % (error.msg, previous, e.msg), **details)
+    raise MarathonError('%s Rolled back to version %s.' % (error.msg, previous), **details)
+
+def verifyDeployed(restbase, user, passwd, params, ret, timeout):
+    # Polling sees failed deployments disappear like completed ones, check the app instead
+    id = appId(params['id'])
+    start = time.time()
+    failed = {ret['deploymentId']: {'outcome': 'failed', 'duration': 0}}
+    current, info = tryRequest(restbase + '/apps' + id, user, passwd, items='app', fields=['version'])
+    if info['status'] == 200 and current and current[0].get('version') != ret['version']:
+        raise MarathonError('Deployment %s failed, the app runs version %s instead of %s.' % (ret['deploymentId'], current[0].get('version'), ret['version']), deployments=failed)
+    if not params['wait_healthy']:
+        try:
+            waitForCapacity(restbase, user, passwd, params, [id], timeout)
+        except MarathonError as e:
+            failed[ret['deploymentId']]['duration'] = time.time() - start
+            raise MarathonError(e.msg, deployments=failed, **e.details)
+
+def deployOrRollback(restbase, user, passwd, params, previous, method, *args):
+    try:
+        timeout = time.time() + (params['waitTimeout'] or 0)
+        ret = method(restbase, user, passwd, params, *args)
+        if previous is not None and params['wait_mode'] != 'events' and 'deploymentId' in ret['meta']:
+            verifyDeployed(restbase, user, passwd, params, ret['meta'], timeout)
+        return ret
+    except MarathonError as e:
+        if previous is None:
+            raise
+        rollback(restbase, user, passwd, params, previous, e)
+
 def present(restbase, user, passwd, params):
-    app, info = tryRequest(restbase + '/apps/' + params['id'], user, passwd)
+    app, info = fetchApp(restbase, user, passwd, params, params['id'])
 
     if info['status'] in (200, 204):
-        # Destroy apps which seem stuck into deployment
+        previous = None
+        if params['on_failure'] == 'rollback' and params['waitTimeout']:
+            previous = previousVersion(restbase, user, passwd, params, app['app'])
+
         if len(app['app']['deployments']) > 0:
-            destroy(restbase, user, passwd, params)
-            return create(restbase, user, passwd, params)
+            if params['stuck_deployment'] == 'recreate':
+                # Destroy apps which seem stuck into deployment
+                destroy(restbase, user, passwd, params)
+                return create(restbase, user, passwd, params)
+            # Cancel the blocking deployments while healthy tasks keep running
+            cancelDeployments(restbase, user, passwd, params, [x['id'] for x in app['app']['deployments']])
+            return deployOrRollback(restbase, user, passwd, params, previous, edit)
+
+        desired = buildApp(params)
+        diff = appDiff(desired, app['app'])
+        if not diff:
+            # Nothing to change, avoid creating a new app version
+            return {'meta': app, 'changed': False}
+        elif params['partial_update'] and not [x for x in diff.values() if isEmpty(x['after'])]:
+            # Only send the changed fields, unless some of them have to be removed
+            data = dict((arg, x['after']) for arg, x in diff.items())
+            if params['fingerprint_label']:
+                # Keep the fingerprint in line with the fields changed
+                data['labels'] = desired['labels']
+            return deployOrRollback(restbase, user, passwd, params, previous, patch, data)
         else:
-            return edit(restbase, user, passwd, params)
+            return deployOrRollback(restbase, user, passwd, params, previous, edit)
     else:
         return create(restbase, user, passwd, params)
 
+def scaled(restbase, user, passwd, params):
+    app, info = fetchApp(restbase, user, passwd, params, params['id'])
+
+    if info['status'] not in (200, 204):
+        raise MarathonError(info['msg'])
+
+    if app['app']['instances'] == params['instances']:
+        return {'meta': app, 'changed': False}
+
+    return patch(restbase, user, passwd, params, {'instances': params['instances']})
+
+def queueEntries(restbase, user, passwd, id):
+    prefix = appId(id)
+    entries = get(restbase + '/queue', user, passwd, items='queue.item', fields=QUEUE_FIELDS)
+    return [x for x in entries if 'app' in x and (x['app']['id'] == prefix or x['app']['id'].startswith(prefix.rstrip('/') + '/'))]
+
+def queueItem(entry):
+    delay = entry.get('delay') or {}
+    offers = entry.get('processedOffersSummary', {}).get('rejectSummaryLastOffers', [])
+    reasons = [{'reason': x['reason'], 'declined': x['declined']} for x in offers if x.get('declined')]
+    return {
+        'id': entry['app']['id'],
+        'count': entry.get('count', 0),
+        'delay': delay.get('timeLeftSeconds', 0),
+        'overdue': delay.get('overdue', False),
+        'since': entry.get('since'),
+        'reasons': sorted(reasons, key=lambda x: -x['declined']),
+    }
+
+def resetDelay(restbase, user, passwd, id):
+    ret, info = tryRequest(restbase + '/queue' + appId(id) + '/delay', user, passwd, method='DELETE')
+
+    # Apps which are not in the launch queue have no delay to reset
+    if info['status'] not in (200, 204, 404):
+        raise MarathonError('Cannot reset the launch delay of %s: %s' % (id, info['msg']), response=ret)
+    return info['status'] != 404
+
+def resetDelays(restbase, user, passwd, params, ids):
+    if params['reset_delay']:
+        for id in ids:
+            resetDelay(restbase, user, passwd, id)
+
+def queue(restbase, user, passwd, params):
+    items = [queueItem(x) for x in queueEntries(restbase, user, passwd, params['id'])]
+
+    reset = []
+    if params['reset_delay']:
+        for item in items:
+            if item['delay'] > 0 and not item['overdue']:
+                if module.check_mode or resetDelay(restbase, user, passwd, item['id']):
+                    reset.append(item['id'])
+
+    return {'meta': {}, 'changed': len(reset) > 0, 'queue': items, 'reset': reset}
+
+def wait(restbase, user, passwd, params):
+    outcomes = trackDeployments(restbase, user, passwd, params, params['deployment_ids'], stopOnFailure=False)
+
+    failed = sorted(id for id, x in outcomes.items() if x['outcome'] != 'success')
+    if failed:
+        raise MarathonError('Deployments did not complete: %s' % ', '.join(failed), deployments=outcomes)
+
+    return {'meta': {}, 'changed': False, 'deployments': outcomes}
+
+def findTasks(restbase, user, passwd, params):
+    tasks = get(restbase + '/tasks', user, passwd, items='tasks.item', fields=['id', 'appId', 'host'])
+
+    if params['task_ids']:
+        ids = set(params['task_ids'])
+        tasks = [x for x in tasks if x['id'] in ids]
+    if params['host']:
+        tasks = [x for x in tasks if x.get('host') == params['host']]
+    if params['id']:
+        tasks = [x for x in tasks if appId(x['appId']) == appId(params['id'])]
+
+    return tasks
+
 def kill(restbase, user, passwd, params):
-    url = restbase + '/apps/' + params['id'] + '/tasks'
-    ret = delete(url, user, passwd, params)
+    query = '?scale=' + str(params['scale']).lower() + '&force=' + str(params['force']).lower()
+    appIds = []
+
+    if params['id'] and not params['task_ids']:
+        # Marathon filters the tasks of a single app by host itself
+        url = restbase + '/apps/' + params['id'] + '/tasks' + query
+        if params['host']:
+            url += '&' + urlencode({'host': params['host']})
+        ret, info = tryRequest(url, user, passwd, method='DELETE')
+        if info['status'] not in (200, 204, 404):
+            raise MarathonError(info['msg'], response=ret)
+        appIds = [appId(params['id'])]
+    else:
+        # Kill the tasks of all the apps at once
+        if params['host'] or params['id']:
+            tasks = findTasks(restbase, user, passwd, params)
+        else:
+            tasks = [{'id': id} for id in params['task_ids']]
+        if not tasks:
+            return {'meta': {}, 'changed': False, 'tasks': []}
 
-    if params['waitTimeout'] and 'deployments' in ret and len(ret['deployments']) > 0:
-        waitForDeployment(restbase, user, passwd, params, ret['deployments'][0]['id'])
+        ret = post(restbase + '/tasks/delete' + query, user, passwd, {'ids': [x['id'] for x in tasks]})
+        appIds = sorted(set(appId(x['appId']) for x in tasks if 'appId' in x))
 
-    return {'meta': ret, 'changed': 'deployments' in ret and len(ret['deployments']) > 0}
+    killed = ret.get('tasks', [])
+    changed = len(killed) > 0 or 'deploymentId' in ret
+
+    if params['waitTimeout'] and changed:
+        if 'deploymentId' in ret:
+            waitForApps(restbase, user, passwd, params, [ret['deploymentId']], appIds)
+        else:
+            # Replacement tasks are launched without any deployment to wait for. Marathon
+            # counts the killed tasks until Mesos reports them killed, wait for that first
+            timeout = time.time() + params['waitTimeout']
+            waitForKilled(restbase, user, passwd, params, killed, timeout)
+            appIds = sorted(set(appId(x['appId']) for x in killed))
+            waitForCapacity(restbase, user, passwd, params, appIds, timeout)
+
+    return {'meta': ret, 'changed': changed, 'tasks': [x['id'] for x in killed]}
+
+def appId(id):
+    return '/' + id.strip('/')
+
+def appDependencies(apps):
+    deps = {}
+    for id, app in apps.items():
+        parent = id.rsplit('/', 1)[0] or '/'
+        deps[id] = set(groupId(dep, parent) for dep in app['dependencies'] or []) & set(apps)
+
+    # Fail fast on cycles, they would never be scheduled
+    remaining = dict((id, set(dep)) for id, dep in deps.items())
+    while remaining:
+        ready = [id for id, dep in remaining.items() if not dep]
+        if not ready:
+            raise MarathonError('Dependency cycle between apps: %s' % ', '.join(sorted(remaining)))
+        for id in ready:
+            del remaining[id]
+        for dep in remaining.values():
+            dep.difference_update(ready)
+
+    return deps
+
+def appsParallel(restbase, user, passwd, params, method, reverse=False):
+    apps = {}
+    for app in params['apps']:
+        app = appParams(params, app)
+        app['id'] = appId(app['id'])
+        apps[app['id']] = app
+
+    deps = appDependencies(apps)
+    if reverse:
+        # Remove dependent apps before the apps they depend on
+        deps = dict((id, set(other for other in deps if id in deps[other])) for id in deps)
+
+    ready = Queue.Queue()
+    done = Queue.Queue()
+
+    # Long-lived workers keep their connections to Marathon from one app to the next
+    def worker():
+        while True:
+            id = ready.get()
+            if id is None:
+                return
+            try:
+                done.put((id, method(restbase, user, passwd, apps[id]), None))
+            except MarathonError as e:
+                done.put((id, None, e))
+            except Exception as e:
+                done.put((id, None, MarathonError(str(e) + ' ' + traceback.format_exc())))
+
+    workers = []
+    for i in range(min(params['max_parallel'], len(apps))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+
+    results = {}
+    errors = {}
+    pending = set(apps)
+    running = set()
+    while running or (pending and not errors):
+        # Queue every app whose dependencies are deployed, the workers take them max_parallel at a time
+        if not errors:
+            for id in sorted(pending):
+                if deps[id] <= set(results):
+                    pending.remove(id)
+                    running.add(id)
+                    ready.put(id)
+
+        id, ret, error = done.get()
+        running.remove(id)
+        if error is not None:
+            errors[id] = dict(msg=error.msg, **error.details)
+        else:
+            results[id] = {'changed': ret['changed']}
+
+    for thread in workers:
+        ready.put(None)
+
+    if errors:
+        raise MarathonError('Operation failed for apps: %s' % ', '.join(sorted(errors)), apps=results, errors=errors, skipped=sorted(pending))
+
+    return {'meta': {}, 'changed': any(x['changed'] for x in results.values()), 'apps': results}
+
+def apps_present(restbase, user, passwd, params):
+    if params['max_parallel']:
+        return appsParallel(restbase, user, passwd, params, present)
+
+    apps = []
+    for app in params['apps']:
+        data = buildApp(appParams(params, app))
+        data['id'] = appId(data['id'])
+        apps.append(data)
+
+    matched = {}
+    if params['fingerprint_label'] and not params['app_cache']:
+        # Only the apps whose fingerprint differs need their definition fetched
+        label = params['fingerprint_label']
+        fingerprints = fetchFingerprints(restbase, user, passwd, params)
+        matched = dict((x['id'], fingerprints[x['id']]) for x in apps if x['id'] in fingerprints and fingerprints[x['id']]['labels'].get(label) == x['labels'][label])
+
+    index = fetchApps(restbase, user, passwd, params, [x['id'] for x in apps if x['id'] not in matched])
+    index.update(matched)
+
+    results = {}
+    changed = []
+    for data in apps:
+        if data['id'] in index:
+            diff = appDiff(data, index[data['id']])
+        else:
+            diff = newAppDiff(data)
+        if diff:
+            changed.append(data)
+        results[data['id']] = {'changed': bool(diff), 'fields': sorted(diff)}
+
+    # Deploy every changed app in a single call
+    ret = {}
+    if changed:
+        url = restbase + '/apps?force=' + str(params['force']).lower()
+        ret = put(url, user, passwd, changed)
+        invalidateAppCache(params, [app['id'] for app in changed])
+        resetDelays(restbase, user, passwd, params, [app['id'] for app in changed])
+
+        if params['waitTimeout']:
+            waitForApps(restbase, user, passwd, params, [ret['deploymentId']], [app['id'] for app in changed])
+
+    return {'meta': ret, 'changed': bool(changed), 'apps': results}
+
+def apps_scaled(restbase, user, passwd, params):
+    if params['max_parallel']:
+        return appsParallel(restbase, user, passwd, params, scaled)
+
+    apps = [appParams(params, app) for app in params['apps']]
+
+    index = fetchApps(restbase, user, passwd, params, [appId(app['id']) for app in apps])
+
+    results = {}
+    changed = []
+    for app in apps:
+        id = appId(app['id'])
+        if id not in index:
+            raise MarathonError('App %s does not exist' % id)
+        if index[id]['instances'] != app['instances']:
+            changed.append({'id': id, 'instances': app['instances']})
+        results[id] = {'changed': index[id]['instances'] != app['instances'], 'instances': app['instances']}
+
+    # Resize every app in a single call
+    ret = {}
+    if changed:
+        url = restbase + '/apps?force=' + str(params['force']).lower()
+        ret = partialUpdate(restbase, user, passwd, params, url, changed)
+        invalidateAppCache(params, [app['id'] for app in changed])
+
+        if params['waitTimeout']:
+            waitForApps(restbase, user, passwd, params, [ret['deploymentId']], [app['id'] for app in changed])
+
+    return {'meta': ret, 'changed': bool(changed), 'apps': results}
+
+def apps_absent(restbase, user, passwd, params):
+    if params['max_parallel']:
+        return appsParallel(restbase, user, passwd, params, absent, reverse=True)
+
+    results = {}
+    deploymentIds = []
+    for app in params['apps']:
+        id = appId(appParams(params, app)['id'])
+        ret = delete(restbase + '/apps' + id, user, passwd, params)
+        invalidateAppCache(params, [id])
+        if 'deploymentId' in ret:
+            deploymentIds.append(ret['deploymentId'])
+        results[id] = {'changed': ret['changed']}
+
+    if params['waitTimeout'] and deploymentIds:
+        waitForDeployments(restbase, user, passwd, params, deploymentIds)
+
+    return {'meta': {'deploymentIds': deploymentIds}, 'changed': len(deploymentIds) > 0, 'apps': results}
+
+def inPrefix(id, prefix):
+    return prefix == '/' or id.startswith(prefix + '/')
+
+def reconcileChanges(restbase, user, passwd, params):
+    prefix = appId(params['prefix'])
+
+    desired = {}
+    for app in params['apps'] or []:
+        app = appParams(params, app)
+        app['id'] = groupId(app['id'], prefix)
+        if not inPrefix(app['id'], prefix):
+            raise MarathonError('App %s is not under %s' % (app['id'], prefix))
+        desired[app['id']] = buildApp(app)
+
+    # Marathon matches the id anywhere in the app id, keep the apps under the prefix only
+    url = restbase + '/apps?' + urlencode([('id', prefix), ('embed', 'apps.deployments')])
+    deployed = dict((x['id'], x) for x in get(url, user, passwd).get('apps', []) if inPrefix(x['id'], prefix))
+
+    changes = dict((id, ('delete', {})) for id in deployed if id not in desired)
+    for id, app in desired.items():
+        if id in deployed:
+            diff = appDiff(app, deployed[id])
+            changes[id] = ('update' if diff else 'no-op', diff)
+        else:
+            changes[id] = ('create', newAppDiff(app))
+
+    deletions = sorted(id for id, (op, diff) in changes.items() if op == 'delete')
+    if len(deletions) > params['max_deletions']:
+        raise MarathonError('Refusing to delete %d apps under %s, more than max_deletions (%d)' % (len(deletions), prefix, params['max_deletions']), deletions=deletions)
+
+    return desired, changes
+
+def apps_reconcile(restbase, user, passwd, params):
+    desired, changes = reconcileChanges(restbase, user, passwd, params)
+
+    results = dict((id, {'changed': op != 'no-op', 'operation': op, 'fields': sorted(diff)}) for id, (op, diff) in changes.items())
+    deploy = [desired[id] for id, (op, diff) in sorted(changes.items()) if op in ('create', 'update')]
+    deletions = sorted(id for id, (op, diff) in changes.items() if op == 'delete')
+
+    # Create and update every app in a single call, then remove the apps left out
+    deploymentIds = []
+    if deploy:
+        url = restbase + '/apps?force=' + str(params['force']).lower()
+        ret = put(url, user, passwd, deploy)
+        invalidateAppCache(params, [app['id'] for app in deploy])
+        resetDelays(restbase, user, passwd, params, [app['id'] for app in deploy])
+        deploymentIds.append(ret['deploymentId'])
+
+    for id in deletions:
+        ret = delete(restbase + '/apps' + id + '?force=' + str(params['force']).lower(), user, passwd, params)
+        invalidateAppCache(params, [id])
+        if 'deploymentId' in ret:
+            deploymentIds.append(ret['deploymentId'])
+
+    if params['waitTimeout'] and deploymentIds:
+        waitForApps(restbase, user, passwd, params, deploymentIds, [app['id'] for app in deploy])
+
+    return {'meta': {'deploymentIds': deploymentIds}, 'changed': len(deploy) + len(deletions) > 0, 'apps': results}
+
+def groupId(id, parent):
+    if id.startswith('/'):
+        return appId(id)
+    return appId(parent.rstrip('/') + '/' + id)
+
+def buildGroup(params, group, parent='/'):
+    data = {'id': groupId(group.get('id') or params['id'], parent)}
+
+    data['apps'] = []
+    for app in group.get('apps', []):
+        app = dict(app)
+        app['id'] = groupId(app.get('id', ''), data['id'])
+        data['apps'].append(buildApp(appParams(params, app)))
+
+    data['groups'] = [buildGroup(params, child, data['id']) for child in group.get('groups', [])]
+
+    # An empty list clears the dependencies left by a previous definition
+    data['dependencies'] = group.get('dependencies') or []
+
+    return data
+
+def groupApps(group):
+    apps = dict((app['id'], app) for app in group.get('apps', []))
+    for child in group.get('groups', []):
+        apps.update(groupApps(child))
+    return apps
+
+def dependencyId(id, group):
+    # Like for apps, relative dependencies are resolved from the parent of the group
+    parts = [] if id.startswith('/') else group.strip('/').split('/')[:-1]
+    for part in id.split('/'):
+        if part == '..':
+            parts = parts[:-1]
+        elif part and part != '.':
+            parts.append(part)
+    return '/' + '/'.join(parts)
+
+def groupFields(group):
+    fields = {group['id']: {
+        'dependencies': sorted(dependencyId(x, group['id']) for x in group.get('dependencies') or []),
+        'groups': sorted(appId(x['id']) for x in group.get('groups') or []),
+    }}
+    for child in group.get('groups') or []:
+        fields.update(groupFields(child))
+    return fields
+
+def groupDiff(desired, current):
+    desired = groupFields(desired)
+    current = groupFields(current) if current else {}
+
+    diff = {}
+    for id, fields in desired.items():
+        for field, value in fields.items():
+            before = current.get(id, {}).get(field, [])
+            if value != before:
+                diff.setdefault(id, {})[field] = {'before': before, 'after': value}
+    return diff
+
+def groupChanges(restbase, user, passwd, params):
+    data = buildGroup(params, params['group'])
+
+    current, info = tryRequest(restbase + '/groups' + data['id'], user, passwd)
+    if info['status'] in (200, 204):
+        deployed = groupApps(current)
+    else:
+        current = None
+        deployed = {}
+
+    # Apps left out of the group definition are removed by Marathon
+    changes = dict((id, ('delete', {})) for id in deployed)
+    for id, app in groupApps(data).items():
+        if id in deployed:
+            diff = appDiff(app, deployed[id])
+            changes[id] = ('update' if diff else 'no-op', diff)
+        else:
+            changes[id] = ('create', newAppDiff(app))
+
+    return data, current, changes, groupDiff(data, current)
+
+def group_present(restbase, user, passwd, params):
+    data, current, changes, groups = groupChanges(restbase, user, passwd, params)
+
+    results = dict((id, {'changed': op != 'no-op', 'fields': sorted(diff)}) for id, (op, diff) in changes.items())
+    groupResults = dict((id, {'changed': True, 'fields': sorted(diff)}) for id, diff in groups.items())
+
+    if not groups and not [id for id in results if results[id]['changed']]:
+        return {'meta': current, 'changed': False, 'apps': results, 'groups': groupResults}
+
+    url = restbase + '/groups' + data['id'] + '?force=' + str(params['force']).lower()
+    ret = put(url, user, passwd, data)
+    invalidateAppCache(params, list(results))
+
+    if params['waitTimeout']:
+        waitForApps(restbase, user, passwd, params, [ret['deploymentId']], [id for id, (op, diff) in changes.items() if op in ('create', 'update')])
+
+    return {'meta': ret, 'changed': True, 'apps': results, 'groups': groupResults}
+
+def group_absent(restbase, user, passwd, params):
+    id = groupId(params['group'].get('id') or params['id'], '/')
+    url = restbase + '/groups' + id + '?force=' + str(params['force']).lower()
+    ret = delete(url, user, passwd, params)
+    if params['waitTimeout'] and ret['changed']:
+        waitForDeployment(restbase, user, passwd, params, ret['deploymentId'])
+    return ret
 
 # Some parameters are required depending on the operation:
 OP_REQUIRED = dict(absent=['id'],
                    present=['id'],
                    restart=['id'],
-                   kill=['id'])
+                   kill=[],
+                   scaled=['id', 'instances'],
+                   wait=['deployment_ids', 'waitTimeout'],
+                   queue=['id'])
+
+# Operations which handle check mode by themselves
+CHECK_MODE_OPERATIONS = ['queue', 'wait']
+
+# Operations supported on a list of apps
+APPS_OPERATIONS = ['absent', 'present', 'scaled', 'reconcile']
+
+# Operations supported on a group
+GROUP_OPERATIONS = ['absent', 'present']
+
+ARGUMENT_SPEC = dict(
+    uri=dict(required=True, type='list'),
+    leader_discovery=dict(default=False, type='bool'),
+    leader_cache_file=dict(type='path'),
+    leader_cache_ttl=dict(default=60, type='int'),
+    state=dict(default='present', choices=['absent', 'present', 'restart', 'kill', 'scaled', 'wait', 'queue', 'reconcile']),
+    username=dict(required=False,default=None),
+    password=dict(required=False,default=None),
+    principal=dict(required=False),
+    principal_password=dict(required=False, no_log=True),
+    private_key=dict(type='path'),
+    login_url=dict(required=False),
+    token_cache_file=dict(type='path'),
+    token_refresh=dict(default=300, type='int'),
+    id=dict(type='str'),
+    cmd=dict(aliases=['command'], type='str'),
+    args=dict(aliases=['arguments'], type='list'),
+    cpus=dict(type='float', default=1.0),
+    mem=dict(default=128.0, aliases=['memory'],type='float'),
+    disk=dict(default=0.0, type='float'),
+    ports=dict(default=[], type='list'),
+    requirePorts=dict(aliases=['require_ports'], default=False, type='bool'),
+    portDefinitions=dict(aliases=['port_definitions'], default=[], type='list'),
+    ipAddress=dict(aliases=['ip_address'],type='dict'),
+    storeUrls=dict(aliases=['store_urls'], default=[], type='list'),
+    instances=dict(type='int'),
+    executor=dict(default="", type='str'),
+    user=dict(type='str'),
+    version=dict(type='str'),
+    versionInfo=dict(aliases=['version_info'],type='dict'),
+    container=dict(type='dict'),
+    docker_image=dict(),
+    docker_forcePullImage=dict(aliases=['docker_force_pull_image'], default=False, type='bool'),
+    docker_privileged=dict(default=False, type='bool'),
+    docker_network=dict(default='NONE', type='str'),
+    docker_parameters=dict(default=[], type='list'),
+    docker_portMappings=dict(aliases=['docker_port_mappings'], default=[], type='list'),
+    container_type=dict(default='MESOS', type='str'),
+    container_volumes=dict(default=[], type='list'),
+    residency=dict(default={}, type='dict'),
+    env=dict(default={}, type='dict'),
+    constraints=dict(default=[], type='list'),
+    acceptedResourceRoles=dict(aliases=['accepted_resource_roles'], default=[], type='list'),
+    labels=dict(default={}, type='dict'),
+    uris=dict(default=[], type='list'),
+    dependencies=dict(default=[], type='list'),
+    fetch=dict(default=[], type='list'),
+    healthChecks=dict(aliases=['health_checks'], default=[], type='list'),
+    readinessChecks=dict(aliases=['readyness_checks'], default=[], type='list'),
+    backoffSeconds=dict(aliases=['backoff_seconds'], type='float', default=1.0),
+    backoffFactor=dict(aliases=['backoff_factor'], type='float', default=1.15),
+    maxLaunchDelaySeconds=dict(aliases=['max_launch_delay_seconds'], type='float', default=3600.0),
+    upgradeStrategy=dict(aliases=['upgrade_strategy'], default={}, type='dict'),
+    upgradeStrategy_minimumHealthCapacity=dict(aliases=['upgrade_strategy_minimum_health_capacity'], type='float'),
+    upgradeStrategy_maximumOverCapacity=dict(aliases=['upgrade_strategy_maximum_over_capacity'], type='float'),
+    force=dict(default=False, type='bool'),
+    host=dict(required=False),
+    task_ids=dict(type='list'),
+    scale=dict(default=False, type='bool'),
+    partial_update=dict(default=False, type='bool'),
+    stuck_deployment=dict(default='recreate', choices=['recreate', 'rollback', 'cancel']),
+    on_failure=dict(default='fail', choices=['fail', 'rollback']),
+    waitTimeout=dict(aliases=['wait_timeout'], type='int'),
+    wait_mode=dict(default='poll', choices=['poll', 'events']),
+    deployment_ids=dict(type='list'),
+    reset_delay=dict(default=False, type='bool'),
+    wait_healthy=dict(default=False, type='bool'),
+    wait_healthy_fraction=dict(default=1.0, type='float'),
+    rate_limit=dict(default=0, type='float'),
+    rate_burst=dict(type='int'),
+    max_deployments=dict(default=0, type='int'),
+    rate_limit_file=dict(type='path'),
+    retries=dict(default=0, type='int'),
+    retry_delay=dict(default=0.5, type='float'),
+    retry_deadline=dict(default=300, type='int'),
+    retry_statuses=dict(default=[409, 503], type='list'),
+    validate_certs=dict(required=False, default=True, type='bool'),
+    compression=dict(default=True, type='bool'),
+    compress_requests=dict(default=0, type='int'),
+    trace_file=dict(type='path'),
+    profile_file=dict(type='path'),
+    return_fields=dict(type='list'),
+    apps=dict(type='list'),
+    max_parallel=dict(type='int', default=0),
+    prefix=dict(required=False),
+    max_deletions=dict(default=5, type='int'),
+    app_cache=dict(default=False, type='bool'),
+    app_cache_id=dict(type='str'),
+    app_cache_label=dict(type='str'),
+    fingerprint_label=dict(type='str'),
+    app_cache_file=dict(type='path'),
+    app_cache_ttl=dict(default=60, type='int'),
+    group=dict(type='dict')
+)
+
+# Options describing a single app, as opposed to options of the module call
+APP_OPTIONS = ['id'] + MARATHON_APP_PARAMETERS + ['docker_image', 'docker_forcePullImage', 'docker_privileged', 'docker_network', 'docker_parameters', 'docker_portMappings', 'container_type', 'container_volumes', 'upgradeStrategy_minimumHealthCapacity', 'upgradeStrategy_maximumOverCapacity']
+
+def prepareParams(params):
+    if params['retry_statuses']:
+        params['retry_statuses'] = [int(status) for status in params['retry_statuses']]
+
+    # Ensure that we use int values for ports
+    if params['ports']:
+        ports = params['ports']
+        ports = [int(port) for port in ports]
+        params['ports'] = ports
+
+    # Ensure that we use int values for ports in port definitions
+    if params['portDefinitions']:
+        portDefinitions = params['portDefinitions']
+        for portDefinition in portDefinitions:
+            if 'port' in portDefinition:
+              portDefinition['port'] = int(portDefinition['port'])
+        params['portDefinitions'] = portDefinitions
+
+    # Ensure that we use int values for port mappings
+    if params['docker_portMappings']:
+        mappings = params['docker_portMappings']
+        for mapping in mappings:
+            for param in ['containerPort', 'hostPort', 'servicePort']:
+                if param in mapping:
+                    mapping[param] = int(mapping[param])
+        params['docker_portMappings'] = mappings
+
+    # Ensure that we use int values for some healthChecks parameters
+    if params['healthChecks']:
+        healthChecks = params['healthChecks']
+        for checks in healthChecks:
+            for param in ['port', 'gracePeriodSeconds', 'intervalSeconds', 'timeoutSeconds', 'maxConsecutiveFailures']:
+                if param in checks:
+                    checks[param] = int(checks[param])
+        params['healthChecks'] = healthChecks
+
+    # Ensure that we use string values for env parameters
+    if params['env']:
+        env = params['env']
+        for key, value in env.items():
+          env[key] = str(env[key])
+        params['env'] = env
+
+    if params['docker_image'] and not params['container']:
+        params['container'] = { 'type': 'DOCKER', 'docker': { 'image': params['docker_image'], 'forcePullImage': bool(params['docker_forcePullImage']), 'privileged': bool(params['docker_privileged']), 'network': params['docker_network'], 'parameters': params['docker_parameters'], 'portMappings': params['docker_portMappings']}, 'volumes': params['container_volumes']}
+    else:
+        if params['container_volumes'] and not params['container']:
+            params['container'] = { 'type': params['container_type'], 'volumes': params['container_volumes']}
+
+    if params['upgradeStrategy_minimumHealthCapacity'] != None:
+        params['upgradeStrategy'].update({'minimumHealthCapacity': params['upgradeStrategy_minimumHealthCapacity']})
+
+    if params['upgradeStrategy_maximumOverCapacity'] != None:
+        params['upgradeStrategy'].update({'maximumOverCapacity': params['upgradeStrategy_maximumOverCapacity']})
+
+    return params
+
+def convertOption(name, value):
+    kind = ARGUMENT_SPEC[name].get('type', 'str')
+    if value is None:
+        return None
+    if kind == 'int':
+        return int(value)
+    if kind == 'float':
+        return float(value)
+    if kind == 'bool':
+        return module.boolean(value)
+    if kind == 'list' and not isinstance(value, list):
+        return [value]
+    return value
+
+def appParams(params, app):
+    aliases = {}
+    for name in APP_OPTIONS:
+        aliases[name] = name
+        for alias in ARGUMENT_SPEC[name].get('aliases', []):
+            aliases[alias] = name
+
+    ret = dict(params)
+    for name in APP_OPTIONS:
+        ret[name] = copy.deepcopy(ARGUMENT_SPEC[name].get('default'))
+
+    for key, value in app.items():
+        if key not in aliases:
+            module.fail_json(msg="Unsupported option %s for app %s" % (key, app.get('id')))
+        ret[aliases[key]] = convertOption(aliases[key], copy.deepcopy(value))
+
+    if not ret['id']:
+        module.fail_json(msg="Missing id for app %s" % app)
+
+    return prepareParams(ret)
 
 def main():
 
     global module
     module = AnsibleModule(
-        argument_spec=dict(
-            uri=dict(required=True),
-            state=dict(default='present', choices=['absent', 'present', 'restart', 'kill']),
-            username=dict(required=False,default=None),
-            password=dict(required=False,default=None),
-            id=dict(type='str',required=True),
-            cmd=dict(aliases=['command'], type='str'),
-            args=dict(aliases=['arguments'], type='list'),
-            cpus=dict(type='float', default=1.0),
-            mem=dict(default=128.0, aliases=['memory'],type='float'),
-            disk=dict(default=0.0, type='float'),
-            ports=dict(default=[], type='list'),
-            requirePorts=dict(aliases=['require_ports'], default=False, type='bool'),
-            portDefinitions=dict(aliases=['port_definitions'], default=[], type='list'),
-            ipAddress=dict(aliases=['ip_address'],type='dict'),
-            storeUrls=dict(aliases=['store_urls'], default=[], type='list'),
-            instances=dict(default=1, type='int'),
-            executor=dict(default="", type='str'),
-            user=dict(type='str'),
-            version=dict(type='str'),
-            versionInfo=dict(aliases=['version_info'],type='dict'),
-            container=dict(type='dict'),
-            docker_image=dict(),
-            docker_forcePullImage=dict(aliases=['docker_force_pull_image'], default=False, type='bool'),
-            docker_privileged=dict(default=False, type='bool'),
-            docker_network=dict(default='NONE', type='str'),
-            docker_parameters=dict(default=[], type='list'),
-            docker_portMappings=dict(aliases=['docker_port_mappings'], default=[], type='list'),
-            container_type=dict(default='MESOS', type='str'),
-            container_volumes=dict(default=[], type='list'),
-            residency=dict(default={}, type='dict'),
-            env=dict(default={}, type='dict'),
-            constraints=dict(default=[], type='list'),
-            acceptedResourceRoles=dict(aliases=['accepted_resource_roles'], default=[], type='list'),
-            labels=dict(default={}, type='dict'),
-            uris=dict(default=[], type='list'),
-            dependencies=dict(default=[], type='list'),
-            fetch=dict(default=[], type='list'),
-            healthChecks=dict(aliases=['health_checks'], default=[], type='list'),
-            readinessChecks=dict(aliases=['readyness_checks'], default=[], type='list'),
-            backoffSeconds=dict(aliases=['backoff_seconds'], type='float', default=1.0),
-            backoffFactor=dict(aliases=['backoff_factor'], type='float', default=1.15),
-            maxLaunchDelaySeconds=dict(aliases=['max_launch_delay_seconds'], type='float', default=3600.0),
-            upgradeStrategy=dict(aliases=['upgrade_strategy'], default={}, type='dict'),
-            upgradeStrategy_minimumHealthCapacity=dict(aliases=['upgrade_strategy_minimum_health_capacity'], type='float'),
-            upgradeStrategy_maximumOverCapacity=dict(aliases=['upgrade_strategy_maximum_over_capacity'], type='float'),
-            force=dict(default=False, type='bool'),
-            waitTimeout=dict(aliases=['wait_timeout'], type='int'),
-            validate_certs=dict(required=False, default=True, type='bool')
-
-        ),
-        supports_check_mode=False
+        argument_spec=ARGUMENT_SPEC,
+        mutually_exclusive=[['apps', 'group']],
+        supports_check_mode=True
     )
 
     state = module.params['state']
 
     # Check we have the necessary per-operation parameters
     missing = []
-    for parm in OP_REQUIRED[state]:
-        if not module.params[parm]:
-            missing.append(parm)
+    if module.params['apps'] or state == 'reconcile':
+        if state not in APPS_OPERATIONS:
+            module.fail_json(msg="Operation %s is not supported with apps" % state)
+        # An empty list of apps is valid, it removes all the apps under the prefix
+        if state == 'reconcile':
+            if module.params['apps'] is None:
+                missing.append('apps')
+            if not module.params['prefix']:
+                missing.append('prefix')
+        if state == 'scaled':
+            missing.extend('instances of %s' % app.get('id') for app in module.params['apps'] if 'instances' not in app)
+    elif module.params['group']:
+        if state not in GROUP_OPERATIONS:
+            module.fail_json(msg="Operation %s is not supported with group" % state)
+        if not module.params['group'].get('id') and not module.params['id']:
+            missing.append('group.id or id')
+    else:
+        for parm in OP_REQUIRED[state]:
+            value = module.params[parm]
+            # Scaling down to zero instances is valid
+            if value is None or (not value and parm != 'instances'):
+                missing.append(parm)
+        if state == 'kill' and not (module.params['id'] or module.params['host'] or module.params['task_ids']):
+            missing.append('id, host or task_ids')
     if missing:
         module.fail_json(msg="Operation %s require the following missing parameters: %s" % (state, ",".join(missing)))
 
+    # Cache files are locked while their entry is refreshed with requests, which use the other files
+    files = [module.params[x] for x in ('leader_cache_file', 'app_cache_file', 'token_cache_file', 'rate_limit_file') if module.params[x]]
+    if len(set(os.path.abspath(x) for x in files)) < len(files):
+        module.fail_json(msg="leader_cache_file, app_cache_file, token_cache_file and rate_limit_file must be different files")
+
+    if module.params['principal']:
+        if not module.params['principal_password'] and not module.params['private_key']:
+            module.fail_json(msg="principal requires principal_password or private_key")
+        if module.params['private_key'] and not HAS_JWT:
+            module.fail_json(msg="The PyJWT library is required to log in with private_key")
+
     # Handle rest of parameters
-    uri = module.params['uri']
     user = module.params['username']
     passwd = module.params['password']
 
@@ -681,76 +3086,50 @@ def main():
 #def fix_marathon_types(a):
 #    return fix_named_type("", a)
 
-    # Ensure that we use int values for ports
-    if module.params['ports']:
-        ports = module.params['ports']
-        ports = [int(port) for port in ports]
-        module.params['ports'] = ports
-
-    # Ensure that we use int values for ports in port definitions
-    if module.params['portDefinitions']:
-        portDefinitions = module.params['portDefinitions']
-        for portDefinition in portDefinitions:
-            if 'port' in portDefinition:
-              portDefinition['port'] = int(portDefinition['port'])
-        module.params['portDefinitions'] = portDefinitions
+    prepareParams(module.params)
 
-    # Ensure that we use int values for port mappings
-    if module.params['docker_portMappings']:
-        mappings = module.params['docker_portMappings']
-        for mapping in mappings:
-            for param in ['containerPort', 'hostPort', 'servicePort']:
-                if param in mapping:
-                    mapping[param] = int(mapping[param])
-        module.params['docker_portMappings'] = mappings
-
-    # Ensure that we use int values for some healthChecks parameters
-    if module.params['healthChecks']:
-        healthChecks = module.params['healthChecks']
-        for checks in healthChecks:
-            for param in ['port', 'gracePeriodSeconds', 'intervalSeconds', 'timeoutSeconds', 'maxConsecutiveFailures']:
-                if param in checks:
-                    checks[param] = int(checks[param])
-        module.params['healthChecks'] = healthChecks
-
-    # Ensure that we use string values for env parameters
-    if module.params['env']:
-        env = module.params['env']
-        for key, value in env.iteritems():
-          env[key] = str(env[key])
-        module.params['env'] = env
-
-    if module.params['docker_image'] and not module.params['container']:
-        module.params['container'] = { 'type': 'DOCKER', 'docker': { 'image': module.params['docker_image'], 'forcePullImage': bool(module.params['docker_forcePullImage']), 'privileged': bool(module.params['docker_privileged']), 'network': module.params['docker_network'], 'parameters': module.params['docker_parameters'], 'portMappings': module.params['docker_portMappings']}, 'volumes': module.params['container_volumes']}
-    else:
-        if module.params['container_volumes'] and not module.params['container']:
-            module.params['container'] = { 'type': module.params['container_type'], 'volumes': module.params['container_volumes']}
-
-    if module.params['upgradeStrategy_minimumHealthCapacity'] != None:
-        module.params['upgradeStrategy'].update({'minimumHealthCapacity': module.params['upgradeStrategy_minimumHealthCapacity']})
-
-    if module.params['upgradeStrategy_maximumOverCapacity'] != None:
-        module.params['upgradeStrategy'].update({'maximumOverCapacity': module.params['upgradeStrategy_maximumOverCapacity']})
-
-    if not uri.endswith('/'):
-        uri = uri + '/'
-    restbase = uri + 'v2'
+    ENDPOINTS['uris'] = [baseUri(uri) for uri in module.params['uri']]
+    ENDPOINTS['uri'] = ENDPOINTS['uris'][0]
 
     # Dispatch
     try:
+        # Logging in and the leader cache may fail too
+        if module.params['leader_discovery']:
+            selectEndpoint(module.params, requestHeaders(user, passwd))
+        restbase = ENDPOINTS['uri'] + 'v2'
 
         # Lookup the corresponding method for this operation. This is
         # safe as the AnsibleModule should remove any unknown operations.
         thismod = sys.modules[__name__]
-        method = getattr(thismod, state)
+        if module.check_mode and state not in CHECK_MODE_OPERATIONS:
+            method = lambda restbase, user, passwd, params: plan(restbase, user, passwd, params, state)
+        elif module.params['apps'] or state == 'reconcile':
+            method = getattr(thismod, 'apps_' + state)
+        elif module.params['group']:
+            method = getattr(thismod, 'group_' + state)
+        else:
+            method = getattr(thismod, state)
+
+        if module.params['profile_file']:
+            profiler = cProfile.Profile()
+            try:
+                ret = profiler.runcall(method, restbase, user, passwd, module.params)
+            finally:
+                profiler.dump_stats(module.params['profile_file'])
+        else:
+            ret = method(restbase, user, passwd, module.params)
 
-        ret = method(restbase, user, passwd, module.params)
+    except MarathonError as e:
+        return module.fail_json(msg=e.msg, uri=ENDPOINTS['uri'], deployment_ids=STARTED_DEPLOYMENTS, http=HTTP_STATS, timings=TIMINGS, **e.details)
 
     except Exception as e:
         return module.fail_json(msg=str(e) + ' ' + traceback.format_exc())
 
 
-    module.exit_json(changed=ret['changed'], uri=uri, state=state, meta=ret['meta'])
+    if module.params['return_fields'] and 'meta' in ret:
+        ret['meta'] = projectFields(ret['meta'], module.params['return_fields'])
+
+    module.exit_json(uri=ENDPOINTS['uri'], state=state, deployment_ids=STARTED_DEPLOYMENTS, http=HTTP_STATS, timings=TIMINGS, **ret)
 
 
 from ansible.module_utils.basic import *
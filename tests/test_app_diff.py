@@ -0,0 +1,79 @@
+import importlib.util
+import os
+
+import pytest
+
+pytest.importorskip('ansible.module_utils.basic')
+
+spec = importlib.util.spec_from_file_location('marathon_app', os.path.join(os.path.dirname(__file__), '..', 'library', 'marathon_app.py'))
+marathon_app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(marathon_app)
+
+
+class FakeModule(object):
+    def __init__(self, **params):
+        self.params = dict({'fingerprint_label': None}, **params)
+
+
+@pytest.fixture(autouse=True)
+def module(monkeypatch):
+    monkeypatch.setattr(marathon_app, 'module', FakeModule(), raising=False)
+
+
+def diff(desired, current):
+    return marathon_app.appDiff(dict(desired, id='/a'), dict(current, id='/a'))
+
+
+def test_env_values_are_compared_as_strings():
+    assert diff({'env': {'PORT': 8080, 'DEBUG': True}}, {'env': {'PORT': '8080', 'DEBUG': 'True'}}) == {}
+    assert 'env' in diff({'env': {'PORT': 8080}}, {'env': {'PORT': '8081'}})
+
+
+def test_removed_env_key_is_a_change():
+    assert 'env' in diff({'env': {'A': '1'}}, {'env': {'A': '1', 'B': '2'}})
+
+
+def test_removed_label_is_a_change():
+    assert 'labels' in diff({'labels': {'team': 'web'}}, {'labels': {'team': 'web', 'owner': 'ops'}})
+
+
+def test_dynamic_ports_match_any_assigned_port():
+    assert diff({'ports': [0, 0]}, {'ports': [10001, 10002]}) == {}
+    assert diff({'portDefinitions': [{'port': 0}]}, {'portDefinitions': [{'port': 10001, 'protocol': 'tcp'}]}) == {}
+    assert 'ports' in diff({'ports': [8080]}, {'ports': [10001]})
+    assert 'ports' in diff({'ports': [0, 0]}, {'ports': [10001]})
+
+
+def test_docker_networking_of_marathon_15_is_normalized():
+    desired = {'container': {'type': 'DOCKER', 'docker': {'image': 'web:1', 'network': 'BRIDGE', 'portMappings': [{'containerPort': 80, 'hostPort': 0}]}}}
+    current = {
+        'container': {'type': 'DOCKER', 'docker': {'image': 'web:1'}, 'portMappings': [{'containerPort': 80, 'hostPort': 31000, 'servicePort': 10000}]},
+        'networks': [{'mode': 'container/bridge'}],
+    }
+    assert diff(desired, current) == {}
+
+    current['networks'] = [{'mode': 'host'}]
+    assert 'container' in diff(desired, current)
+
+
+def test_upgrade_strategy_matches_a_subset():
+    current = {'upgradeStrategy': {'minimumHealthCapacity': 1, 'maximumOverCapacity': 1}}
+    assert diff({'upgradeStrategy': {'minimumHealthCapacity': 1.0}}, current) == {}
+    assert diff({}, current) == {}
+    assert 'upgradeStrategy' in diff({'upgradeStrategy': {'minimumHealthCapacity': 0.5}}, current)
+
+
+def test_server_filled_fields_are_ignored():
+    current = {'cmd': 'sleep 100', 'cpus': 1, 'mem': 128, 'backoffFactor': 1.15, 'maxLaunchDelaySeconds': 3600, 'version': '2016-08-31T12:00:00.000Z'}
+    assert diff({'cmd': 'sleep 100'}, current) == {}
+    assert 'mem' in diff({'cmd': 'sleep 100', 'mem': 256}, current)
+    assert diff({'cmd': 'sleep 100', 'instances': 2}, {'cmd': 'sleep 100', 'instances': 2.0}) == {}
+    assert diff({'cmd': 'sleep 200'}, {'cmd': 'sleep 100'}) == {'cmd': {'before': 'sleep 100', 'after': 'sleep 200'}}
+
+
+def test_matching_fingerprint_only_compares_instances(monkeypatch):
+    monkeypatch.setattr(marathon_app, 'module', FakeModule(fingerprint_label='FP'))
+    desired = {'cmd': 'sleep 100', 'instances': 1, 'labels': {'FP': 'abc'}}
+    assert diff(desired, {'cmd': 'sleep 200', 'instances': 1, 'labels': {'FP': 'abc'}}) == {}
+    assert diff(desired, {'cmd': 'sleep 100', 'instances': 5, 'labels': {'FP': 'abc'}}) == {'instances': {'before': 5, 'after': 1}}
+    assert 'cmd' in diff(desired, {'cmd': 'sleep 200', 'instances': 1, 'labels': {'FP': 'old'}})
@@ -0,0 +1,73 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('ansible.module_utils.basic')
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import fake_marathon
+
+
+@pytest.fixture
+def marathon():
+    marathon = fake_marathon.Marathon()
+    server = fake_marathon.Server(marathon).start()
+    marathon.url = server.url
+    yield marathon
+    server.stop()
+
+
+def run(marathon, tmpdir, check=False, **params):
+    params['uri'] = [marathon.url]
+    if check:
+        params['_ansible_check_mode'] = True
+    path = str(tmpdir.join('args.json'))
+    with open(path, 'w') as f:
+        json.dump({'ANSIBLE_MODULE_ARGS': params}, f)
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'library', 'marathon_app.py'), path], stdout=subprocess.PIPE)
+    out = process.communicate()[0]
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def deploy(marathon, *ids):
+    for id in ids:
+        marathon.add_app({'id': id, 'cmd': 'sleep 100', 'instances': 1})
+
+
+def test_refuses_more_deletions_than_max_deletions(marathon, tmpdir):
+    deploy(marathon, '/web/a', '/web/b', '/web/c')
+
+    ret = run(marathon, tmpdir, state='reconcile', prefix='/web', apps=[], max_deletions=2)
+
+    assert ret['failed']
+    assert ret['deletions'] == ['/web/a', '/web/b', '/web/c']
+    assert sorted(marathon.apps) == ['/web/a', '/web/b', '/web/c']
+
+
+def test_only_prunes_apps_under_the_prefix(marathon, tmpdir):
+    deploy(marathon, '/web/a', '/web/old', '/webx/b', '/api/c')
+
+    ret = run(marathon, tmpdir, state='reconcile', prefix='/web', apps=[{'id': 'a', 'cmd': 'sleep 100'}])
+
+    assert not ret.get('failed'), ret.get('msg')
+    assert ret['apps']['/web/old']['operation'] == 'delete'
+    assert '/webx/b' not in ret['apps']
+    # Deletions complete with the next tick of the fake server
+    marathon.tick()
+    assert sorted(marathon.apps) == ['/api/c', '/web/a', '/webx/b']
+
+
+def test_check_mode_only_plans(marathon, tmpdir):
+    deploy(marathon, '/web/a', '/web/old')
+
+    ret = run(marathon, tmpdir, check=True, state='reconcile', prefix='/web', apps=[{'id': 'a', 'cmd': 'sleep 200'}, {'id': 'new', 'cmd': 'sleep 100'}])
+
+    assert ret['changed']
+    assert dict((x['id'], x['operation']) for x in ret['plan']) == {'/web/a': 'update', '/web/new': 'create', '/web/old': 'delete'}
+    assert sorted(marathon.apps) == ['/web/a', '/web/old']
+    assert marathon.apps['/web/a']['cmd'] == 'sleep 100'